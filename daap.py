@@ -8,20 +8,46 @@
 # copyright 2005 Tom Insam <tom@jerakeen.org>
 #
 
-import httplib, struct, sys
-import md5, md5daap
-import gzip
+# keep this list short - anything that's only needed once we're actually
+# talking to a server (httplib, gzip, ...) is imported where it's used, so
+# that importing this module stays cheap. daap_startup.py keeps us honest.
+import struct, sys, time
+import threading
+import md5daap
 import logging
+from collections import OrderedDict, deque
 from cStringIO import StringIO
 
-__all__ = ['DAAPError', 'DAAPObject', 'DAAPClient', 'DAAPSession', 'DAAPDatabase', 'DAAPPlaylist', 'DAAPTrack']
+__all__ = ['DAAPError', 'DAAPObject', 'DAAPClient', 'DAAPSession', 'DAAPDatabase', 'DAAPPlaylist', 'DAAPTrack',
+    'DAAPTransport', 'HTTPTransport', 'RecordingTransport', 'ReplayTransport',
+    'DAAPRequestStats', 'DAAPStats', 'DAAPProfiler']
 
 log = logging.getLogger('daap')
 
-# the itunes authentication hasher
-seed_v2 = []
-for i in (range(255)):
-    ctx = md5.new()
+# the itunes authentication hasher. Only one selector is ever used, so the
+# seeds are generated the first time they're asked for, not at import.
+class _LazySeeds(object):
+    """a read-only list of hasher seeds, built on demand"""
+
+    def __init__(self, generate):
+        self.generate = generate
+        self.seeds = {}
+
+    def __len__(self):
+        return 255
+
+    def __getitem__(self, select):
+        try:
+            return self.seeds[select]
+        except KeyError:
+            if not 0 <= select < 255:
+                raise IndexError(select)
+            seed = self.seeds[select] = self.generate(select)
+            return seed
+
+def _generate_seed_v2(i):
+    from hashlib import md5
+    ctx = md5()
     if (i & 0x80): ctx.update("Accept-Language")
     else:          ctx.update("user-agent")
 
@@ -46,12 +72,11 @@ for i in (range(255)):
     if (i & 0x01): ctx.update("session-id")
     else:          ctx.update("content-codes")
 
-    seed_v2.append( ctx.hexdigest().upper() )
+    return ctx.hexdigest().upper()
 
 # this is a translation of the GenerateHash function in hasher.c of
 # libopendaap http://crazney.net/programs/itunes/authentication.html
-seed_v3 = []
-for i in (range(255)):
+def _generate_seed_v3(i):
     ctx = md5daap.new()
 
     if (i & 0x40): ctx.update("eqwsdxcqwesdc")
@@ -78,22 +103,75 @@ for i in (range(255)):
     if (i & 0x80): ctx.update("IUYHGFDCXWEDFGHN")
     else:          ctx.update("iuytgfdxwerfghjm")
 
-    seed_v3.append( ctx.hexdigest().upper() )
+    return ctx.hexdigest().upper()
+
+seed_v2 = _LazySeeds(_generate_seed_v2)
+seed_v3 = _LazySeeds(_generate_seed_v3)
+
+class _LRUCache(object):
+    """a small, thread-safe, least-recently-used mapping"""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.items[key] = value
+            return value
+        finally:
+            self.lock.release()
+
+    def put(self, key, value):
+        self.lock.acquire()
+        try:
+            self.items.pop(key, None)
+            self.items[key] = value
+            while len(self.items) > self.size:
+                self.items.popitem(last = False)
+        finally:
+            self.lock.release()
+
+    def discard(self, key):
+        self.lock.acquire()
+        try:
+            self.items.pop(key, None)
+        finally:
+            self.lock.release()
+
+# most requests are for the same handful of urls with the same request id,
+# so remember the last few validation hashes rather than redoing them.
+_hash_cache = _LRUCache(64)
 
 def hash_v2(url, select):
-    ctx = md5.new()
-    ctx.update( url )
-    ctx.update( "Copyright 2003 Apple Computer, Inc." )
-    ctx.update( seed_v2[ select ])
-    return ctx.hexdigest().upper()
+    key = ('v2', url, select)
+    value = _hash_cache.get(key)
+    if value is None:
+        from hashlib import md5
+        ctx = md5()
+        ctx.update( url )
+        ctx.update( "Copyright 2003 Apple Computer, Inc." )
+        ctx.update( seed_v2[ select ])
+        value = ctx.hexdigest().upper()
+        _hash_cache.put(key, value)
+    return value
 
 def hash_v3(url, select, sequence = 0):
-    ctx = md5daap.new()
-    ctx.update( url )
-    ctx.update( "Copyright 2003 Apple Computer, Inc." )
-    ctx.update( seed_v3[ select ])
-    if sequence > 0: ctx.update( str(sequence) )
-    return ctx.hexdigest().upper()
+    key = ('v3', url, select, sequence)
+    value = _hash_cache.get(key)
+    if value is None:
+        ctx = md5daap.new()
+        ctx.update( url )
+        ctx.update( "Copyright 2003 Apple Computer, Inc." )
+        ctx.update( seed_v3[ select ])
+        if sequence > 0: ctx.update( str(sequence) )
+        value = ctx.hexdigest().upper()
+        _hash_cache.put(key, value)
+    return value
 
 
 
@@ -177,10 +255,32 @@ def DAAPParseCodeTypes(treeroot):
         else:
             raise DAAPError('DAAPParseCodeTypes: unexpected code %s at level 1' % info.codeName())
 
-class DAAPError(Exception): pass
+class DAAPError(Exception):
+    # the HTTP status of the response that caused the error, if any
+    status = None
+
+def _is_zlib_header(data):
+    """true if data starts with a valid zlib (RFC 1950) stream header"""
+    if len(data) < 2:
+        return False
+    cmf, flg = ord(data[0]), ord(data[1])
+    return cmf & 0x0f == 8 and ((cmf << 8) | flg) % 31 == 0
 
 class DAAPObject(object):
 
+    def __init__(self, code = None, value = None):
+        """objects read off the wire are built empty and filled in by
+        processData. To build one to encode, pass a code, and either its
+        value or, for containers, a list of the DAAPObjects it contains."""
+        if code is None:
+            return
+        self.code = code
+        self.type = dmapCodeTypes[code][1]
+        if self.type == 'c':
+            self.contains = value or []
+        else:
+            self.value = value
+
     def getAtom(self, code):
         """returns an atom of the given code by searching 'contains' recursively."""
         if self.code == code:
@@ -192,7 +292,7 @@ class DAAPObject(object):
         if hasattr(self, 'contains'):
             for object in self.contains:
                 value = object.getAtom(code)
-                if value: return value
+                if value is not None: return value
         return None
 
     def codeName(self):
@@ -216,35 +316,42 @@ class DAAPObject(object):
             for object in self.contains:
                 object.printTree(level + 1)
 
-    def encode(self):
+    def encode(self, cache = None, _listing = None):
+        """returns this object as DMAP data. If a DAAPEncodeCache is passed,
+        listing items (mlit) whose values haven't changed since last time
+        are looked up in it rather than re-encoded."""
         # generate DMAP tagged data format
         # step 1 - find out what type of object we are
         if self.type == 'c':
+            if cache is not None and self.code == 'mlit':
+                data = cache.encodeObject(self, _listing)
+                if data is not None:
+                    return data
+            # items are cached per response type - a playlist and a track
+            # can have the same id
+            if self.code not in ('mlcl', 'mlit'):
+                _listing = self.code
             # our object is a container,
             # this means we're going to have to
             # check contains[]
-            value   = ''
-            for item in self.contains:
-                # get the data stream from each of the sub elements
-                value += item.encode()
-            # get the length of the data
-            length  = len(value)
+            # get the data stream from each of the sub elements
+            value   = ''.join([item.encode(cache, _listing) for item in self.contains])
             # pack: 4 byte code, 4 byte length, length bytes of value
-            data    = struct.pack('!4sI%ss' % length, self.code, length, value)
-            return data
+            return encodeContainer(self.code, value)
 
         elif self.type == 'v':
             # packing a version tag is about 1 point different to everything
             # below, but it means it won't fit into our abstract packing
-            value   = self.value.split('.')
+            value   = str(self.value).split('.')
             length  = struct.calcsize('!HH')
-            data    = struct.pack('!4sIHH', self.code, length, value[0], value[1])
+            data    = struct.pack('!4sIHH', self.code, length, int(value[0]), int(value[1]))
             return data
         else:
             # we don't have to traverse anything
             # to calculate the length and such
             # we want to encode the contents of
             # value for our value
+            value = self.value
             if self.type == 'l':
                 packing = 'q'
             elif self.type == 'ul':
@@ -264,14 +371,17 @@ class DAAPObject(object):
             elif self.type == 't':
                 packing = 'I'
             elif self.type == 's':
-                packing = '%ss' % len(self.value)
+                # strings go over the wire as utf-8
+                if isinstance(value, unicode):
+                    value = value.encode('utf-8')
+                packing = '%ss' % len(value)
             else:
                 raise DAAPError('DAAPObject: encode: unknown code %s' % self.code)
                 return
             # calculate the length of what we're packing
             length  = struct.calcsize('!%s' % packing)
             # pack: 4 characters for the code, 4 bytes for the length, and 'length' bytes for the value
-            data    = struct.pack('!4sI%s' % packing, self.code, length, self.value)
+            data    = struct.pack('!4sI%s' % packing, self.code, length, value)
             return data
 
     def processData(self, str):
@@ -351,28 +461,626 @@ class DAAPObject(object):
             log.debug('DAAPObject: Unknown code %s for type %s, writing raw data', code, self.code)
             self.value  = code
 
+# struct formats for the fixed size atom types
+_atomFormats = {'l': '!q', 'ul': '!Q', 'i': '!i', 'ui': '!I', 'h': '!h',
+    'uh': '!H', 'b': '!b', 'ub': '!B', 't': '!I'}
+
+def _decodeAtom(type, data):
+    """the value of an atom of the given type, from its raw bytes. The
+    same conversions as DAAPObject.processData."""
+    format = _atomFormats.get(type)
+    if format is not None:
+        return struct.unpack(format, data)[0]
+    elif type == 's':
+        try:
+            return unicode(data, 'utf-8')
+        except UnicodeDecodeError:
+            return unicode(data, 'latin-1')
+    elif type == 'v':
+        return float("%s.%s" % struct.unpack('!HH', data))
+    return data
+
+def _listingBounds(data):
+    """the (start, end) of the body of the listing (mlcl) in a response,
+    or None if there isn't one"""
+    unpack = struct.unpack_from
+    # skip the outer container, and look for the listing in it
+    position, end = 8, len(data)
+    while position < end:
+        code, length = unpack('!4sI', data, position)
+        position += 8
+        if code == 'mlcl':
+            return position, position + length
+        position += length
+    return None
+
+class _RawItem(object):
+    """A listing item (mlit) left where it is in the response data - a
+    string, or the mmap of a spooled response - with its fields decoded
+    as they're asked for. Stands in for the DAAPObject in a DAAPTrack."""
+
+    __slots__ = ('data', 'start', 'end')
+    code = 'mlit'
+    type = 'c'
+
+    def __init__(self, data, start, end):
+        self.data = data
+        self.start = start
+        self.end = end
+
+    def getAtom(self, code):
+        unpack = struct.unpack_from
+        data, position, end = self.data, self.start, self.end
+        while position < end:
+            atom, size = unpack('!4sI', data, position)
+            position += 8
+            if atom == code:
+                return _decodeAtom(dmapCodeTypes.get(code, (None, None))[1], data[position:position + size])
+            position += size
+        return None
+
+    def printTree(self, level = 0, out = sys.stdout):
+        """decodes the item into DAAPObjects and prints those"""
+        object = DAAPObject()
+        object.processData(StringIO(struct.pack('!4sI', self.code, self.end - self.start)
+            + self.data[self.start:self.end]))
+        object.printTree(level, out)
+
+def parallel(function, items, concurrency):
+    """calls function(item) for every item on up to 'concurrency' threads,
+    yielding (item, result, error) tuples in the order the calls finish.
+    One of result and error is always None, so one failure doesn't lose
+    the rest."""
+    import Queue
+    items = list(items)
+    pending = Queue.Queue()
+    for item in items:
+        pending.put(item)
+    finished = Queue.Queue()
+
+    def worker():
+        while True:
+            try:
+                item = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                finished.put((item, function(item), None))
+            except Exception, e:
+                log.debug('parallel: %r failed: %s', item, e)
+                finished.put((item, None, e))
+
+    for i in range(min(max(concurrency, 1), len(items))):
+        thread = threading.Thread(target = worker)
+        thread.setDaemon(True)
+        thread.start()
+
+    for i in range(len(items)):
+        yield finished.get()
+
+def listingItems(data):
+    """a _RawItem for each item in the listing of a response"""
+    bounds = _listingBounds(data)
+    if bounds is None:
+        return []
+    unpack = struct.unpack_from
+    items = []
+    position, end = bounds
+    while position < end:
+        code, length = unpack('!4sI', data, position)
+        position += 8
+        if code == 'mlit':
+            items.append(_RawItem(data, position, position + length))
+        position += length
+    return items
+
+# the raw readers are in daap_path.py, imported once they're wanted
+def listingRows(data, codes):
+    """Yields a tuple of the values of 'codes' for each item (mlit) in the
+    listing (mlcl) of a response - see daap_path.listingRows"""
+    import daap_path
+    return daap_path.listingRows(data, codes)
+
+def listingColumns(data, codes, processes = None, threshold = 8 * 1024 * 1024):
+    """the values of each of 'codes' for every item in the listing of a
+    response, as a list of columns - see daap_path.listingColumns"""
+    import daap_path
+    return daap_path.listingColumns(data, codes, processes, threshold)
+
+# path -> DAAPPath, compiled the first time it's used
+_paths = {}
+
+def _path(path):
+    compiled = _paths.get(path)
+    if compiled is None:
+        from daap_path import DAAPPath
+        compiled = _paths[path] = DAAPPath(path)
+    return compiled
+
+def listingDeleted(data):
+    """the ids in the deleted items list (mudl) of an update response, or
+    None if it doesn't have one - meaning it isn't a delta"""
+    unpack = struct.unpack_from
+    position, end = 8, len(data)
+    while position < end:
+        code, length = unpack('!4sI', data, position)
+        position += 8
+        if code == 'mudl':
+            ids, stop = [], position + length
+            while position < stop:
+                code, size = unpack('!4sI', data, position)
+                if code == 'miid':
+                    ids.append(unpack('!I', data, position + 8)[0])
+                position += 8 + size
+            return ids
+        position += length
+    return None
+
+def browseNames(data):
+    """the names in a /browse response, which are bare strings in mlit
+    atoms, rather than the containers mlit usually is"""
+    unpack = struct.unpack_from
+    position, end = 8, len(data)
+    while position < end:
+        code, length = unpack('!4sI', data, position)
+        position += 8
+        if code in ('abar', 'abal', 'abgn', 'abcp', 'mlcl'):
+            names, stop = [], position + length
+            while position < stop:
+                code, size = unpack('!4sI', data, position)
+                position += 8
+                names.append(_decodeAtom('s', data[position:position + size]))
+                position += size
+            return names
+        position += length
+    return []
+
+def encodeContainer(code, body):
+    """wraps already-encoded atoms in a container atom"""
+    return struct.pack('!4sI', code, len(body)) + body
+
+
+class DAAPTransport(object):
+    """Something that can make a GET request to a DAAP server. request()
+    returns an httplib-style response: it has a 'status', getheader(),
+    read([size]) and close(). If it's passed a DAAPRequestStats, it fills
+    in the 'connect' time."""
+
+    def request(self, path, headers, stats = None):
+        raise NotImplementedError
+
+
+class HTTPTransport(DAAPTransport):
+    """Talks HTTP to a real server."""
+
+    def __init__(self, hostname, port = 3689):
+        self.hostname = hostname
+        self.port = port
+        self._local = threading.local()
+
+    def _socket(self):
+        """returns the HTTP connection for the calling thread. We reconnect
+        on every request anyway, so each thread can just have its own."""
+        socket = getattr(self._local, 'socket', None)
+        if socket is None:
+            import httplib
+            socket = httplib.HTTPConnection(self.hostname, self.port)
+            self._local.socket = socket
+        return socket
+
+    def request(self, path, headers, stats = None):
+        # there are servers that don't allow >1 download from a single HTTP
+        # session, or something. Reset the connection each time. Thanks to
+        # Fernando Herrera for this one.
+        socket = self._socket()
+        socket.close()
+        start = time.time()
+        socket.connect()
+        if stats is not None:
+            stats.connect = time.time() - start
+        socket.request('GET', path, None, headers)
+        return socket.getresponse()
+
+
+class ReplayResponse(object):
+    """A response read back from a recording. Optionally pretends to come
+    down a link with the given bandwidth, in bytes per second."""
+
+    def __init__(self, status, headers, filename, bandwidth = None):
+        self.status = status
+        self.headers = dict([(k.lower(), v) for k, v in headers])
+        self.file = open(filename, 'rb')
+        self.bandwidth = bandwidth
+
+    def getheader(self, name, default = None):
+        return self.headers.get(name.lower(), default)
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self, size = -1):
+        data = self.file.read(size)
+        if self.bandwidth and data:
+            time.sleep(float(len(data)) / self.bandwidth)
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _recording_name(directory, path):
+    """the filename, minus extension, that a response for path is saved as.
+    The session id changes on every login, so it isn't part of the name."""
+    import os, re
+    from hashlib import sha1
+    path = re.sub(r'([?&])session-id=[^&]*&?', r'\1', path).rstrip('?&')
+    return os.path.join(directory, sha1(path).hexdigest())
+
+def _load_recording(name, bandwidth = None):
+    import json
+    f = open(name + '.json')
+    try:
+        meta = json.load(f)
+    finally:
+        f.close()
+    return ReplayResponse(meta['status'], meta['headers'], name + '.body', bandwidth)
+
+
+class RecordingTransport(DAAPTransport):
+    """Passes requests through to another transport, saving every response
+    to 'directory' so that ReplayTransport can serve them back later. If
+    the same path is requested twice, the last response wins."""
+
+    def __init__(self, transport, directory):
+        import os
+        self.transport = transport
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def request(self, path, headers, stats = None):
+        import json
+        response = self.transport.request(path, headers, stats)
+        name = _recording_name(self.directory, path)
+        body = open(name + '.body', 'wb')
+        try:
+            data = response.read(64 * 1024)
+            while data:
+                body.write(data)
+                data = response.read(64 * 1024)
+        finally:
+            body.close()
+            response.close()
+        f = open(name + '.json', 'w')
+        try:
+            json.dump({'path':path, 'status':response.status,
+                'headers':response.getheaders()}, f)
+        finally:
+            f.close()
+        return _load_recording(name)
+
+
+class ReplayTransport(DAAPTransport):
+    """Serves responses saved by a RecordingTransport, without touching the
+    network. 'latency' seconds are added before every response, and
+    'bandwidth' (bytes per second) limits how fast bodies can be read."""
+
+    def __init__(self, directory, latency = 0, bandwidth = None):
+        self.directory = directory
+        self.latency = latency
+        self.bandwidth = bandwidth
+
+    def request(self, path, headers, stats = None):
+        import os
+        name = _recording_name(self.directory, path)
+        if not os.path.exists(name + '.json'):
+            raise DAAPError('ReplayTransport: no recording for %s' % path)
+        if self.latency:
+            time.sleep(self.latency)
+        return _load_recording(name, self.bandwidth)
+
+
+def _endpoint_template(r):
+    """the request path with the ids taken out, so that requests can be
+    grouped: '/databases/1/items/23.mp3' -> '/databases/{id}/items/{id}.mp3'"""
+    parts = r.split('?')[0].split('/')
+    for i, part in enumerate(parts):
+        name, dot, extension = part.partition('.')
+        if name.isdigit():
+            parts[i] = '{id}' + dot + extension
+    return '/'.join(parts)
+
+
+class DAAPRequestStats(object):
+    """How a single request went. Durations are in seconds, and are zero
+    for any stage the request didn't get to. 'error' is the exception the
+    request failed with, if any."""
+
+    # the durations, in the order they happen
+    timings = ['queue_wait', 'connect', 'ttfb', 'transfer', 'decompress', 'parse']
+
+    def __init__(self, r):
+        self.endpoint = _endpoint_template(r)
+        self.path = r
+        self.started = time.time()
+        self.status = None
+        self.error = None
+        self.retries = 0
+        self.compressed_bytes = 0
+        self.expanded_bytes = 0
+        for name in self.timings:
+            setattr(self, name, 0.0)
+
+    def total(self):
+        return sum([getattr(self, name) for name in self.timings])
+
+
+class DAAPStats(object):
+    """Collects DAAPRequestStats and reports percentiles per endpoint. It's
+    a listener, so to use one:
+
+        stats = DAAPStats()
+        client.listeners.append(stats)
+
+    Percentiles are over the last 'window' requests to each endpoint;
+    counts and byte totals are since the start."""
+
+    def __init__(self, window = 1000):
+        self.window = window
+        self.samples = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, stats):
+        self.lock.acquire()
+        try:
+            samples = self.samples.get(stats.endpoint)
+            if samples is None:
+                samples = self.samples[stats.endpoint] = deque(maxlen = self.window)
+                self.totals[stats.endpoint] = dict.fromkeys(
+                    ['count', 'errors', 'retries', 'compressed_bytes', 'expanded_bytes'], 0)
+            samples.append(stats)
+            totals = self.totals[stats.endpoint]
+            totals['count'] += 1
+            if stats.error is not None:
+                totals['errors'] += 1
+            totals['retries'] += stats.retries
+            totals['compressed_bytes'] += stats.compressed_bytes
+            totals['expanded_bytes'] += stats.expanded_bytes
+        finally:
+            self.lock.release()
+
+    def endpoints(self):
+        return sorted(self.samples.keys())
+
+    def percentile(self, endpoint, name, percent):
+        """the given percentile of a timing ('ttfb', 'parse', ...), or of
+        'total', for requests to endpoint"""
+        self.lock.acquire()
+        try:
+            samples = list(self.samples.get(endpoint, []))
+        finally:
+            self.lock.release()
+        if not samples:
+            return None
+        if name == 'total':
+            values = sorted([s.total() for s in samples])
+        else:
+            values = sorted([getattr(s, name) for s in samples])
+        # nearest rank
+        rank = int(round(percent / 100.0 * len(values) + 0.5)) - 1
+        return values[min(max(rank, 0), len(values) - 1)]
+
+    def summary(self, percents = (50, 90, 99)):
+        """{endpoint: {'count': n, ..., 'ttfb': {50: seconds, ...}, ...}}"""
+        summary = {}
+        for endpoint in self.endpoints():
+            self.lock.acquire()
+            try:
+                entry = dict(self.totals[endpoint])
+            finally:
+                self.lock.release()
+            for name in DAAPRequestStats.timings + ['total']:
+                entry[name] = dict([(p, self.percentile(endpoint, name, p)) for p in percents])
+            summary[endpoint] = entry
+        return summary
+
+
+class DAAPProfiler(object):
+    """Counts what the parser and the object model spend their time on. Set
+    a client's 'profiler' to one of these to turn it on:
+
+        client.profiler = DAAPProfiler(capture = 5)
+
+    It counts the atoms parsed per type, the bytes seen per content code,
+    atoms with codes we don't know the type of, and how often each
+    DAAPTrack attribute is read. If 'capture' is set, every request also
+    runs under cProfile, and the profiles of the 'capture' slowest are
+    kept, to be written out with dump()."""
+
+    def __init__(self, capture = 0):
+        self.capture = capture
+        self.atoms = {}
+        self.bytes = {}
+        self.unknown = {}
+        self.attributes = {}
+        self.slowest = []
+        self.lock = threading.Lock()
+
+    def countTree(self, root):
+        """counts the atoms in a parsed response"""
+        atoms, bytes, unknown = {}, {}, {}
+        pending = [root]
+        while pending:
+            object = pending.pop()
+            if not hasattr(object, 'code'):
+                continue
+            atoms[object.type] = atoms.get(object.type, 0) + 1
+            bytes[object.code] = bytes.get(object.code, 0) + object.length + 8
+            if object.type is None:
+                unknown[object.code] = unknown.get(object.code, 0) + 1
+            if object.type == 'c':
+                pending.extend(object.contains)
+
+        self.lock.acquire()
+        try:
+            for counts, totals in ((atoms, self.atoms), (bytes, self.bytes), (unknown, self.unknown)):
+                for key, count in counts.iteritems():
+                    totals[key] = totals.get(key, 0) + count
+        finally:
+            self.lock.release()
+
+    def attribute(self, name):
+        self.lock.acquire()
+        try:
+            self.attributes[name] = self.attributes.get(name, 0) + 1
+        finally:
+            self.lock.release()
+
+    def offer(self, stats, profile):
+        """keeps the profile of a finished request if it's one of the
+        slowest we've seen"""
+        self.lock.acquire()
+        try:
+            self.slowest.append((stats.total(), stats.path, profile))
+            self.slowest.sort(key = lambda entry: entry[0], reverse = True)
+            del self.slowest[self.capture:]
+        finally:
+            self.lock.release()
+
+    def dump(self, directory):
+        """writes the captured profiles to directory, slowest first, for
+        pstats or any other profile viewer. Returns the filenames."""
+        import os, re
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filenames = []
+        for rank, (elapsed, path, profile) in enumerate(list(self.slowest)):
+            name = re.sub(r'[^\w.-]+', '_', path.split('?')[0]).strip('_')
+            filename = os.path.join(directory, '%02d-%s-%dms.prof' % (rank + 1, name, elapsed * 1000))
+            profile.dump_stats(filename)
+            filenames.append(filename)
+        return filenames
+
+    def report(self, out = sys.stdout):
+        def table(title, counts):
+            out.write('%s\n' % title)
+            for key, count in sorted(counts.items(), key = lambda item: -item[1]):
+                out.write('\t%s\t%s\n' % (key, count))
+        table('atoms parsed, by type', self.atoms)
+        table('bytes, by content code', self.bytes)
+        table('atoms with unknown codes', self.unknown)
+        table('DAAPTrack attribute reads', self.attributes)
+        out.write('slowest requests\n')
+        for elapsed, path, profile in self.slowest:
+            out.write('\t%.3fs\t%s\n' % (elapsed, path))
+
+
+class _StreamedResponse(object):
+    """Wraps a raw response, like a track download, counting what's read
+    through it, and reports its stats when it's closed."""
+
+    def __init__(self, client, response, stats, scheduled = None, limited = False):
+        self.client = client
+        # the thread that opened it, which holds its scheduler slot
+        self.owner = threading.current_thread()
+        self.response = response
+        self.stats = stats
+        self.reported = False
+        # the scheduler class this is counted in, if any, and whether it
+        # counts against the client's limiter
+        self.scheduled = scheduled
+        self.limited = limited
+
+    def __getattr__(self, name):
+        return getattr(self.response, name)
+
+    def read(self, size = -1):
+        start = time.time()
+        if size is None or size < 0:
+            # httplib reads to the end of the connection for read(-1)
+            data = self.response.read()
+        else:
+            data = self.response.read(size)
+        if self.scheduled == 'bulk':
+            self.client.scheduler.throttle(len(data))
+        self.stats.transfer += time.time() - start
+        self.stats.compressed_bytes += len(data)
+        self.stats.expanded_bytes += len(data)
+        return data
+
+    def close(self):
+        self.response.close()
+        if not self.reported:
+            self.reported = True
+            if self.scheduled is not None:
+                self.client.scheduler.release(self.scheduled, self.owner)
+            if self.limited:
+                self.client.limiter.release(self.stats.status, self.stats.ttfb)
+            self.client._report(self.stats)
+
+
 class DAAPClient(object):
-    def __init__(self):
-        self.socket = None
+
+    # how much we read from the socket, and the most we'll decompress, at
+    # a time. Keeps peak memory for big gzipped responses sensible.
+    read_size = 64 * 1024
+
+    # refuse to expand a compressed response past this many bytes, so a
+    # broken or hostile server can't fill up memory. None for no limit.
+    max_expanded_size = 1024 * 1024 * 1024
+
+    # decode listings bigger than parse_threshold bytes for rows() and
+    # columns() in this many processes. None to do it all in this one.
+    parse_processes = None
+    parse_threshold = 8 * 1024 * 1024
+
+    # write responses that expand past spool_threshold bytes to a temporary
+    # file in spool_directory (None for the system default) and map it,
+    # rather than keeping them in memory. tracks() then leaves each track
+    # in the file until its fields are asked for.
+    spool_threshold = None
+    spool_directory = None
+
+    def __init__(self, transport = None):
+        """transport is what actually talks to the server - by default, an
+        HTTPTransport to whatever we connect() to."""
+        self.transport = transport
+        self.hostname = None
         self.request_id = 0
         self._old_itunes = 0
-
-    def connect(self, hostname, port = 3689, password = None):
-        if self.socket != None:
+        # called with a DAAPRequestStats after every request
+        self.listeners = []
+        # a DAAPProfiler, if we're profiling
+        self.profiler = None
+        # a daap_scheduling.DAAPScheduler, to prioritise requests
+        self.scheduler = None
+        # a daap_scheduling.DAAPLimiter, to find out how much the server can take
+        self.limiter = None
+
+    def connect(self, hostname, port = 3689, password = None, content_codes = True):
+        """connects to a server. Pass content_codes = False to skip
+        fetching /content-codes, if dmapCodeTypes already has the server's
+        - it's shared by every client."""
+        if self.hostname != None:
             raise DAAPError("DAAPClient: already connected.")
         self.hostname = hostname
         self.port     = port
         self.password = password
-        self.socket = httplib.HTTPConnection(hostname, port)
-        self.getContentCodes() # practically required
+        if self.transport is None:
+            self.transport = HTTPTransport(hostname, port)
+        if content_codes:
+            self.getContentCodes() # practically required
         self.getInfo() # to determine the remote server version
 
-    def _get_response(self, r, params = {}, gzip = 1):
+    def _get_response(self, r, params = {}, gzip = 1, stats = None):
         """Makes a request, doing the right thing, returns the raw data"""
 
         if params:
             l = ['%s=%s' % (k, v) for k, v in params.iteritems()]
             r = '%s?%s' % (r, '&'.join(l))
+        if stats is not None:
+            stats.path = r
 
         log.debug('getting %s', r)
 
@@ -382,7 +1090,7 @@ class DAAPClient(object):
             "User-Agent": "PythonDaap/0.7.2 (http://movieos.org/code/pythondaap/)",
         }
 
-        if gzip: headers['Accept-encoding'] = 'gzip'
+        if gzip: headers['Accept-encoding'] = 'gzip, deflate'
         
         if self.password:
             import base64
@@ -392,61 +1100,254 @@ class DAAPClient(object):
         # TODO - we should allow for different versions of itunes - there
         # are a few different hashing algos we could be using. I need some
         # older versions of iTunes to test against.
-        if self.request_id > 0:
-            headers[ 'Client-DAAP-Request-ID' ] = self.request_id
+        # read once, in case another thread bumps it while we're here
+        request_id = self.request_id
+        if request_id > 0:
+            headers[ 'Client-DAAP-Request-ID' ] = request_id
 
         if (self._old_itunes):
             headers[ 'Client-DAAP-Validation' ] = hash_v2(r, 2)
         else:
-            headers[ 'Client-DAAP-Validation' ] = hash_v3(r, 2, self.request_id)
+            headers[ 'Client-DAAP-Validation' ] = hash_v3(r, 2, request_id)
 
-        # there are servers that don't allow >1 download from a single HTTP
-        # session, or something. Reset the connection each time. Thanks to
-        # Fernando Herrera for this one.
-        self.socket.close()
-        self.socket.connect()
-
-        self.socket.request('GET', r, None, headers)
+        start = time.time()
+        response = self.transport.request(r, headers, stats)
+        if stats is not None:
+            stats.ttfb = time.time() - start - stats.connect
+        return response
 
-        response    = self.socket.getresponse()
-        return response;
+    def _report(self, stats):
+        """tells the listeners how a request went"""
+        for listener in self.listeners:
+            try:
+                listener(stats)
+            except Exception:
+                log.exception('DAAPClient: listener %r failed', listener)
 
-    def request(self, r, params = {}, answers = 1):
+    def request(self, r, params = {}, answers = 1, readFunc = None, priority = None,
+            spool_threshold = None):
         """Make a request to the DAAP server, with the passed params. This
-        deals with all the cikiness like validation hashes, etc, etc"""
-
-        # this returns an HTTP response object
-        response    = self._get_response(r, params)
-        status = response.status
-        content = response.read()
-        # if we got gzipped data base, gunzip it.
-        if response.getheader("Content-Encoding") == "gzip":
-            log.debug("gunzipping data")
-            old_len = len(content)
-            compressedstream = StringIO( content )
-            gunzipper = gzip.GzipFile(fileobj=compressedstream)
-            content = gunzipper.read()
-            log.debug("expanded from %s bytes to %s bytes", old_len, len(content))
-        # close this, we're done with it
-        response.close()
-
-        if status == 401:
-            raise DAAPError('DAAPClient: %s: auth required'%r)
-        elif status == 403:
-            raise DAAPError('DAAPClient: %s: Authentication failure'%r)
-        elif status == 503:
-            raise DAAPError('DAAPClient: %s: 503 - probably max connections to server'%r)
-        elif status == 204:
-            # no content, ie logout messages
-            return None
-        elif status != 200:
-            raise DAAPError('DAAPClient: %s: Error %s making request'%(r, response.status))
+        deals with all the cikiness like validation hashes, etc, etc.
+        The response is parsed into DAAPObjects, unless a readFunc is
+        passed - then it's called with the raw response data instead, and
+        what it returns is returned. If there's a scheduler, 'priority' is
+        the class to queue in, rather than the one it picks. A
+        spool_threshold overrides the client's for this request."""
+
+        stats = DAAPRequestStats(r)
+        profiler = self.profiler
+        profile = None
+        if profiler is not None and profiler.capture:
+            import cProfile
+            profile = cProfile.Profile()
+            profile.enable()
+        scheduled = None
+        limiter = self.limiter
+        try:
+            if self.scheduler is not None:
+                name = priority or self.scheduler.classify(r, params)
+                stats.queue_wait = self.scheduler.acquire(name, params.get('session-id'))
+                scheduled = name
+            try:
+                while True:
+                    status = None
+                    if limiter is not None:
+                        stats.queue_wait += limiter.acquire()
+                    try:
+                        # this returns an HTTP response object
+                        response    = self._get_response(r, params, stats = stats)
+                        status = stats.status = response.status
+                        try:
+                            content = self._read_content(response, r, stats, spool_threshold)
+                        finally:
+                            # close this, we're done with it
+                            response.close()
+                    finally:
+                        if limiter is not None:
+                            limiter.release(status, stats.ttfb)
+                    if status != 503 or limiter is None or stats.retries >= limiter.retries:
+                        break
+                    stats.retries += 1
+                    time.sleep(limiter.backoff(stats.retries))
+            finally:
+                if scheduled is not None:
+                    self.scheduler.release(scheduled)
+
+            if status == 204:
+                # no content, ie logout messages
+                return None
+            elif status != 200:
+                if status == 401:
+                    error = DAAPError('DAAPClient: %s: auth required'%r)
+                elif status == 403:
+                    error = DAAPError('DAAPClient: %s: Authentication failure'%r)
+                elif status == 503:
+                    error = DAAPError('DAAPClient: %s: 503 - probably max connections to server'%r)
+                else:
+                    error = DAAPError('DAAPClient: %s: Error %s making request'%(r, response.status))
+                error.status = status
+                raise error
+
+            start = time.time()
+            if readFunc is not None:
+                object = readFunc( content )
+            else:
+                object = self.readResponse( content )
+                if profiler is not None:
+                    profiler.countTree(object)
+            stats.parse = time.time() - start
+            return object
+        except Exception, e:
+            stats.error = e
+            raise
+        finally:
+            if profile is not None:
+                profile.disable()
+                profiler.offer(stats, profile)
+            self._report(stats)
+
+    def stream(self, r, params = {}, priority = 'bulk'):
+        """Makes a request for raw data, like a track download, and returns
+        the response without reading it. The request is reported to the
+        listeners, and leaves the scheduler, when the response is closed -
+        until then it holds a slot of its 'priority' class."""
+        stats = DAAPRequestStats(r)
+        scheduled = None
+        limited = False
+        try:
+            if self.scheduler is not None:
+                stats.queue_wait = self.scheduler.acquire(priority, params.get('session-id'))
+                scheduled = priority
+            limiter = self.limiter
+            while True:
+                if limiter is not None:
+                    stats.queue_wait += limiter.acquire()
+                    limited = True
+                response = self._get_response(r, params, gzip = 0, stats = stats)
+                if response.status != 503 or limiter is None or stats.retries >= limiter.retries:
+                    break
+                response.close()
+                limited = False
+                limiter.release(503)
+                stats.retries += 1
+                time.sleep(limiter.backoff(stats.retries))
+        except Exception, e:
+            if limited:
+                self.limiter.release()
+            if scheduled is not None:
+                self.scheduler.release(scheduled)
+            stats.error = e
+            self._report(stats)
+            raise
+        stats.status = response.status
+        return _StreamedResponse(self, response, stats, scheduled, limited)
+
+    def _read_body(self, response, r, stats = None):
+        """Yields the body of the response in chunks of at most read_size
+        bytes, decompressing it as it comes off the socket if the server
+        gzipped or deflated it. Transfer and decompression times, and the
+        sizes, are added to stats."""
+        if stats is None:
+            stats = DAAPRequestStats(r)
+
+        def read():
+            start = time.time()
+            data = response.read(self.read_size)
+            stats.transfer += time.time() - start
+            stats.compressed_bytes += len(data)
+            return data
+
+        encoding = response.getheader("Content-Encoding")
+        if encoding not in ('gzip', 'deflate'):
+            data = read()
+            while data:
+                stats.expanded_bytes += len(data)
+                yield data
+                data = read()
+            return
+
+        log.debug("decompressing %s data", encoding)
+        import zlib
+        decompressor = None
+        expanded = 0
+        data = read()
+        while data:
+            if decompressor is None:
+                if encoding == 'gzip':
+                    wbits = 16 + zlib.MAX_WBITS
+                elif _is_zlib_header(data):
+                    wbits = zlib.MAX_WBITS
+                else:
+                    # 'deflate' is meant to have a zlib wrapper, but
+                    # plenty of servers send a raw deflate stream.
+                    wbits = -zlib.MAX_WBITS
+                decompressor = zlib.decompressobj(wbits)
+            # bound each chunk, then carry on with whatever input is left
+            while data:
+                start = time.time()
+                chunk = decompressor.decompress(data, self.read_size)
+                stats.decompress += time.time() - start
+                expanded += len(chunk)
+                self._check_expanded(expanded, r)
+                if chunk:
+                    yield chunk
+                data = decompressor.unconsumed_tail
+            data = read()
+
+        if decompressor is not None:
+            chunk = decompressor.flush()
+            expanded += len(chunk)
+            self._check_expanded(expanded, r)
+            if chunk:
+                yield chunk
+        stats.expanded_bytes = expanded
+        log.debug("expanded from %s bytes to %s bytes", stats.compressed_bytes, expanded)
+
+    def _read_content(self, response, r, stats, spool_threshold = None):
+        """the whole body of the response: a string, or, if it's bigger than
+        spool_threshold, a read only mmap of a temporary file it's been
+        decompressed into"""
+        body = self._read_body(response, r, stats)
+        if spool_threshold is None:
+            spool_threshold = self.spool_threshold
+        if spool_threshold is None:
+            return ''.join(body)
+        chunks, size = [], 0
+        for chunk in body:
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > spool_threshold:
+                break
+        else:
+            return ''.join(chunks)
+
+        import tempfile, mmap
+        log.debug("spooling %s to disk", r)
+        spool = tempfile.TemporaryFile(prefix = 'daap-', dir = self.spool_directory)
+        try:
+            for chunk in chunks:
+                spool.write(chunk)
+            del chunks
+            for chunk in body:
+                spool.write(chunk)
+            spool.flush()
+            # the file goes away once nothing maps it any more
+            return mmap.mmap(spool.fileno(), 0, access = mmap.ACCESS_READ)
+        finally:
+            spool.close()
 
-        return self.readResponse( content )
+    def _check_expanded(self, expanded, r):
+        if self.max_expanded_size is not None and expanded > self.max_expanded_size:
+            raise DAAPError('DAAPClient: %s: response expands past %s bytes'%(r, self.max_expanded_size))
 
     def readResponse(self, data):
         """Convert binary response from a request to a DAAPObject"""
-        str = StringIO(data)
+        if isinstance(data, basestring):
+            str = StringIO(data)
+        else:
+            # a spooled response, which reads like a file
+            str = data
+            str.seek(0)
         object  = DAAPObject()
         object.processData(str)
         return object
@@ -485,15 +1386,21 @@ class DAAPSession(object):
         self.sessionid  = sessionid
         self.revision   = 1
 
-    def request(self, r, params = {}, answers = 1):
+    def request(self, r, params = {}, answers = 1, readFunc = None, priority = None,
+            spool_threshold = None):
         """Pass the request through to the connection, adding the session-id
         parameter."""
         params['session-id'] = self.sessionid
-        return self.connection.request(r, params, answers)
+        return self.connection.request(r, params, answers, readFunc, priority, spool_threshold)
 
     def update(self):
-        response = self.request("/update")
-        #response.printTree()
+        """asks the server for its current revision number, remembers it
+        in self.revision and returns it"""
+        response = self.request("/update", {})
+        revision = response.getAtom("musr")
+        if revision is not None:
+            self.revision = revision
+        return self.revision
 
     def databases(self):
         response = self.request("/databases")
@@ -514,15 +1421,20 @@ class DAAPSession(object):
 # available to the client.
 daap_atoms = "dmap.itemid,dmap.itemname,daap.songalbum,daap.songartist,daap.songformat,daap.songtime,daap.songsize,daap.songgenre,daap.songyear,daap.songtracknumber"
 
+
 class DAAPDatabase(object):
 
     def __init__(self, session, atom):
         self.session = session
-        self.name = atom.getAtom("minm")
-        self.id = atom.getAtom("miid")
+        self.name, self.id = _path('mlit/{minm,miid}').first(atom)
+        # group kind -> how the server lets us list them
+        self.browsing = {}
 
     def tracks(self):
         """returns all the tracks in this database, as DAAPTrack objects"""
+        if self.session.connection.spool_threshold is not None:
+            return self.session.request("/databases/%s/items"%self.id, {'meta':daap_atoms},
+                readFunc = lambda data: [DAAPTrack(self, t) for t in listingItems(data)])
         response = self.session.request("/databases/%s/items"%self.id, {
             'meta':daap_atoms
         })
@@ -530,28 +1442,165 @@ class DAAPDatabase(object):
         track_list = response.getAtom("mlcl").contains
         return [DAAPTrack(self, t) for t in track_list]
 
+    def fingerprints(self):
+        """a DAAPFingerprints of every track in this database, to compare
+        with a later one. Only the fingerprints are kept."""
+        from daap_fingerprints import listingFingerprints
+        return self.session.request("/databases/%s/items"%self.id, {'meta':daap_atoms},
+            readFunc = listingFingerprints)
+
+    def changes(self, since):
+        """What's changed since the DAAPFingerprints 'since', from one fetch
+        of the whole listing - for servers that don't do deltas. Returns
+        (fingerprints now, [DAAPTracks added or changed], [ids removed]).
+        Only the tracks that changed are decoded."""
+        from daap_fingerprints import DAAPFingerprints, _fingerprintItems
+        def read(data):
+            found = list(_fingerprintItems(data))
+            now = DAAPFingerprints.fromItems([(id, hash) for id, hash, start, end in found])
+            added, removed, changed = since.diff(now)
+            wanted = set(added) | set(changed)
+            # copied out, so the tracks don't keep the whole response
+            tracks = [DAAPTrack(self, _RawItem(data[start:end], 0, end - start))
+                for id, hash, start, end in found if id in wanted]
+            return now, tracks, removed
+        return self.session.request("/databases/%s/items"%self.id, {'meta':daap_atoms},
+            readFunc = read)
+
+    def rows(self, fields = ('id', 'name', 'artist', 'album'), spool_threshold = None):
+        """Yields a tuple of the named fields (see DAAPTrack.attrmap) for
+        every track in this database. Much cheaper than tracks() for big
+        libraries, as no DAAPTrack or DAAPObject is built. A
+        spool_threshold overrides the connection's for this listing."""
+        return _trackRows(self.session, "/databases/%s/items"%self.id, fields, spool_threshold)
+
+    def columns(self, fields = ('id', 'name', 'artist', 'album')):
+        """Returns a dict of each of the named fields to a list of its
+        value for every track in this database, in the same order. Big
+        libraries are decoded in connection.parse_processes processes."""
+        return _trackColumns(self.session, "/databases/%s/items"%self.id, fields)
+
+    # group kind -> the track field it groups on
+    groupFields = {'artists':'artist', 'albums':'album', 'genres':'genre'}
+
+    def artists(self, start = 0, count = None):
+        """the artists in this database - see groups()"""
+        return self.groups('artists', start, count)
+
+    def albums(self, start = 0, count = None):
+        """the albums in this database - see groups()"""
+        return self.groups('albums', start, count)
+
+    def genres(self, start = 0, count = None):
+        """the genres in this database - see groups()"""
+        return self.groups('genres', start, count)
+
+    def groups(self, kind, start = 0, count = None):
+        """Returns the distinct artists, albums or genres ('kind') in this
+        database as a list of (name, number of tracks), sorted by name,
+        'count' of them from 'start' (or all of them). Servers that have
+        /groups answer this with a short listing; servers that only have
+        /browse don't give the number of tracks, so that's None; and for
+        servers with neither we go through the track listing."""
+        if count is not None and count <= 0:
+            return []
+        params = {}
+        if start or count is not None:
+            params['index'] = '%s-%s'%(start, start + count - 1) if count is not None else '%s-'%start
+        ways = self.browsing.get(kind) and [self.browsing[kind]] or ['groups', 'browse', 'scan']
+        error = None
+        for way in ways:
+            try:
+                result = getattr(self, '_groupsBy' + way.capitalize())(kind, dict(params), start, count)
+            except DAAPError, e:
+                if e.status not in (400, 404, 500, 501):
+                    raise
+                log.debug('DAAPDatabase: no %s for %s: %s', way, kind, e)
+                error = e
+                continue
+            self.browsing[kind] = way
+            return result
+        raise error
+
+    def _groupsByGroups(self, kind, params, start, count):
+        params['group-type'] = kind
+        params['meta'] = 'dmap.itemname,dmap.itemcount'
+        return self.session.request("/databases/%s/groups"%self.id, params,
+            readFunc = lambda data: list(listingRows(data, ['minm', 'mimc'])))
+
+    def _groupsByBrowse(self, kind, params, start, count):
+        names = self.session.request("/databases/%s/browse/%s"%(self.id, kind), params,
+            readFunc = browseNames)
+        return [(name, None) for name in names]
+
+    def _groupsByScan(self, kind, params, start, count):
+        counts = {}
+        for (value,) in self.rows((self.groupFields[kind],)):
+            if value:
+                counts[value] = counts.get(value, 0) + 1
+        groups = sorted(counts.items(), key = lambda item: item[0].lower())
+        return groups[start:start + count if count is not None else None]
+
     def playlists(self):
         response = self.session.request("/databases/%s/containers"%self.id)
         db_list = response.getAtom("mlcl").contains
         return [DAAPPlaylist(self, d) for d in db_list]
 
+    def snapshot_playlists(self, concurrency = 4):
+        """fetches the tracks of every playlist in this database, with up to
+        'concurrency' requests in flight at once. Yields (playlist, tracks,
+        error) tuples in the order the requests finish - one of tracks and
+        error is always None, so one broken playlist doesn't lose the rest."""
+        playlists = self.playlists()
+        for result in parallel(DAAPPlaylist.tracks, playlists, concurrency):
+            yield result
+
 
 class DAAPPlaylist(object):
 
     def __init__(self, database, atom):
         self.database = database
-        self.id = atom.getAtom("miid")
-        self.name = atom.getAtom("minm")
-        self.count = atom.getAtom("mimc")
+        self.id, self.name, self.count, base = _path('mlit/{miid,minm,mimc,abpl}').first(atom)
+        # the base playlist is the whole library
+        self.base = bool(base)
 
     def tracks(self):
         """returns all the tracks in this playlist, as DAAPTrack objects"""
+        if self.database.session.connection.spool_threshold is not None:
+            return self.database.session.request(
+                "/databases/%s/containers/%s/items"%(self.database.id,self.id), {'meta':daap_atoms},
+                readFunc = lambda data: [DAAPTrack(self.database, t) for t in listingItems(data)])
         response = self.database.session.request("/databases/%s/containers/%s/items"%(self.database.id,self.id), {
             'meta':daap_atoms
         })
         track_list = response.getAtom("mlcl").contains
         return [DAAPTrack(self.database, t) for t in track_list]
 
+    def rows(self, fields = ('id',), spool_threshold = None):
+        """Yields a tuple of the named fields for every track in this
+        playlist, like DAAPDatabase.rows()"""
+        return _trackRows(self.database.session,
+            "/databases/%s/containers/%s/items"%(self.database.id, self.id), fields,
+            spool_threshold)
+
+def _trackRows(session, r, fields, spool_threshold = None):
+    if session.connection.parse_processes:
+        import itertools
+        columns = _trackColumns(session, r, fields)
+        return itertools.izip(*[columns[field] for field in fields])
+    codes = [DAAPTrack.attrmap[field] for field in fields]
+    meta = ','.join([dmapCodeTypes[code][0] for code in codes])
+    return session.request(r, {'meta': meta},
+        readFunc = lambda data: listingRows(data, codes), spool_threshold = spool_threshold)
+
+def _trackColumns(session, r, fields):
+    connection = session.connection
+    codes = [DAAPTrack.attrmap[field] for field in fields]
+    meta = ','.join([dmapCodeTypes[code][0] for code in codes])
+    columns = session.request(r, {'meta': meta}, readFunc = lambda data: listingColumns(
+        data, codes, connection.parse_processes, connection.parse_threshold))
+    return dict(zip(fields, columns))
+
 
 class DAAPTrack(object):
 
@@ -561,7 +1610,10 @@ class DAAPTrack(object):
         'id':'miid',
         'type':'asfm',
         'time':'astm',
-        'size':'assz'}
+        'size':'assz',
+        'genre':'asgn',
+        'year':'asyr',
+        'tracknumber':'astn'}
 
     def __init__(self, database, atom):
         self.database = database
@@ -571,6 +1623,9 @@ class DAAPTrack(object):
         if self.__dict__.has_key(name):
             return self.__dict__[name]
         elif DAAPTrack.attrmap.has_key(name):
+            profiler = self.database.session.connection.profiler
+            if profiler is not None:
+                profiler.attribute(name)
             return self.atom.getAtom(DAAPTrack.attrmap[name])
         raise AttributeError, name
 
@@ -582,12 +1637,33 @@ class DAAPTrack(object):
         self.database.session.connection.request_id += 1
 
         # get the raw response object directly, not the parsed version
-        return self.database.session.connection._get_response(
+        return self.database.session.connection.stream(
             "/databases/%s/items/%s.%s"%(self.database.id, self.id, self.type),
             { 'session-id':self.database.session.sessionid },
-            gzip = 0,
         )
 
+    def artwork(self, size = 300):
+        """returns the track's cover art, as image data in whatever format
+        the server sends (usually JPEG or PNG), or None if it hasn't any.
+        'size' is the width and height in pixels we'd like; the server may
+        ignore it."""
+        connection = self.database.session.connection
+        connection.request_id += 1
+        response = connection.stream(
+            "/databases/%s/items/%s/extra_data/artwork"%(self.database.id, self.id),
+            { 'session-id':self.database.session.sessionid, 'mw':size, 'mh':size },
+            # someone's probably looking at it, so don't queue behind downloads
+            priority = 'metadata',
+        )
+        try:
+            if response.status in (204, 404):
+                return None
+            elif response.status != 200:
+                raise DAAPError('DAAPTrack: artwork: Error %s making request'%response.status)
+            return response.read()
+        finally:
+            response.close()
+
     def save(self, filename):
         """saves the file to 'filename' on the local machine"""
         log.debug("saving to '%s'", filename)
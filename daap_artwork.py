@@ -0,0 +1,210 @@
+# daap_artwork.py
+#
+# Cover art for DAAP tracks, fetched in the background and kept in a size
+# bounded cache on disk. Art is per album, so tracks of the same album on
+# the same server share one fetch and one cache entry.
+#
+#   fetcher = ArtworkFetcher(ArtworkCache('~/.cache/daap-artwork'))
+#   fetcher.prefetch(tracks[:50])        # the page we're showing
+#   image = fetcher.get(tracks[0])       # waits if it's still coming
+#
+
+import os, time
+import threading, Queue
+import logging
+from collections import OrderedDict
+
+__all__ = ['ArtworkCache', 'ArtworkFetcher']
+
+log = logging.getLogger('daap.artwork')
+
+
+class ArtworkCache(object):
+    """Image data on disk under 'directory', one file per key, least
+    recently used first out once there's more than max_bytes. An empty
+    entry records that there's no artwork, so we don't keep asking."""
+
+    def __init__(self, directory, max_bytes = 64 * 1024 * 1024):
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # filename -> size, least recently used first
+        self.entries = OrderedDict()
+        self.total = 0
+        found = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.art'):
+                stat = os.stat(os.path.join(self.directory, name))
+                found.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(found):
+            self.entries[name] = size
+            self.total += size
+
+    def key(self, *parts):
+        import hashlib
+        return hashlib.sha1(repr(parts)).hexdigest() + '.art'
+
+    def get(self, key):
+        """the data for key, '' if we know there's no artwork, or None if
+        we don't know"""
+        self.lock.acquire()
+        try:
+            if key not in self.entries:
+                return None
+            self.entries[key] = self.entries.pop(key)
+        finally:
+            self.lock.release()
+        filename = os.path.join(self.directory, key)
+        try:
+            f = open(filename, 'rb')
+            try:
+                data = f.read()
+            finally:
+                f.close()
+            # the modification time orders the entries next time we start
+            os.utime(filename, None)
+            return data
+        except (IOError, OSError), e:
+            log.debug('ArtworkCache: lost %s: %s', key, e)
+            self.lock.acquire()
+            self.total -= self.entries.pop(key, 0)
+            self.lock.release()
+            return None
+
+    def put(self, key, data):
+        filename = os.path.join(self.directory, key)
+        temporary = '%s.%s.tmp' % (filename, threading.currentThread().ident)
+        f = open(temporary, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(temporary, filename)
+
+        self.lock.acquire()
+        try:
+            self.total += len(data) - self.entries.pop(key, 0)
+            self.entries[key] = len(data)
+            evict = []
+            while self.total > self.max_bytes and len(self.entries) > 1:
+                name, size = self.entries.popitem(last = False)
+                self.total -= size
+                evict.append(name)
+        finally:
+            self.lock.release()
+        for name in evict:
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+
+
+class ArtworkFetcher(object):
+    """Gets cover art for DAAPTracks through an ArtworkCache, with up to
+    'concurrency' requests in flight. 'size' is passed on to
+    DAAPTrack.artwork()."""
+
+    def __init__(self, cache, concurrency = 4, size = 300):
+        self.cache = cache
+        self.concurrency = concurrency
+        self.size = size
+        self.queue = Queue.Queue()
+        # cache key -> threading.Event, set when the fetch is done
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def key(self, track):
+        """tracks with the same key share artwork: the same album on the
+        same server. Tracks without an album get their own."""
+        connection = track.database.session.connection
+        album = track.album or ('track', track.id)
+        return self.cache.key('%s:%s' % (connection.hostname, connection.port),
+            track.database.id, album, self.size)
+
+    def prefetch(self, tracks):
+        """starts fetching the artwork of tracks in the background, once
+        per album, skipping whatever's cached or already on its way.
+        Returns how many fetches were started."""
+        started = 0
+        for track in tracks:
+            key = self.key(track)
+            if self._start(key):
+                self.queue.put((key, track))
+                started += 1
+        if started:
+            self._startThreads()
+        return started
+
+    def get(self, track, timeout = 30):
+        """the artwork for track, or None if it has none. Waits up to
+        'timeout' seconds for a fetch already in flight - returning None
+        if it doesn't finish - or fetches it now."""
+        key = self.key(track)
+        if self._start(key):
+            self._fetch(key, track)
+        else:
+            self.lock.acquire()
+            event = self.pending.get(key)
+            self.lock.release()
+            if event is not None:
+                event.wait(timeout)
+        return self.cache.get(key) or None
+
+    def _start(self, key):
+        """True if we should fetch key: it's not cached or being fetched"""
+        self.lock.acquire()
+        try:
+            if key in self.pending or key in self.cache.entries:
+                return False
+            self.pending[key] = threading.Event()
+            return True
+        finally:
+            self.lock.release()
+
+    def _fetch(self, key, track):
+        try:
+            start = time.time()
+            data = track.artwork(self.size)
+            log.debug('ArtworkFetcher: %s for %r in %.3fs', data and len(data) or 'nothing',
+                track.album, time.time() - start)
+            self.cache.put(key, data or '')
+        except Exception, e:
+            # don't cache failures, so we try again next time
+            log.debug('ArtworkFetcher: artwork for %r failed: %s', track.album, e)
+        finally:
+            self.lock.acquire()
+            event = self.pending.pop(key)
+            self.lock.release()
+            event.set()
+
+    def _startThreads(self):
+        # workers take themselves out of self.threads, under the lock,
+        # before they go - so any in it will see what's been queued
+        self.lock.acquire()
+        try:
+            for i in range(self.concurrency - len(self.threads)):
+                thread = threading.Thread(target = self._worker)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def _worker(self):
+        while True:
+            try:
+                key, track = self.queue.get(timeout = 5)
+            except Queue.Empty:
+                self.lock.acquire()
+                try:
+                    # something may have been queued since we gave up
+                    if self.queue.empty():
+                        self.threads.remove(threading.currentThread())
+                        return
+                finally:
+                    self.lock.release()
+                continue
+            self._fetch(key, track)
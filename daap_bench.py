@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+#
+# Repeatable benchmarks for the client. Each scenario runs in a fresh
+# interpreter, against a synthetic library served by daap_server.py in
+# another process (or responses recorded from a real server), and
+# reports wall time, peak RSS and how many objects its result keeps
+# alive - plus the peak allocated memory, on Pythons that have
+# tracemalloc.
+#
+#   python daap_bench.py                       # run the default scenarios
+#   python daap_bench.py parse-items-100k      # just the named ones
+#   python daap_bench.py --list
+#   python daap_bench.py --save new.json --compare baseline.json
+#   python daap_bench.py --profile parse-items-10k
+#
+# To benchmark against a real server, record it once, then replay:
+#
+#   python daap_bench.py --record responses --host itunes.local connect
+#   python daap_bench.py --replay responses connect
+#
+
+import gc, os, sys, time
+import optparse
+import subprocess
+from collections import OrderedDict
+
+import json
+
+from daap import DAAPClient, HTTPTransport, RecordingTransport, ReplayTransport
+
+# name -> (setup function, arguments, run by default)
+scenarios = OrderedDict()
+
+def scenario(name, default = True, **kwargs):
+    """registers a scenario. The function is called with kwargs to set
+    things up, and returns the callable that gets timed."""
+    def register(function):
+        scenarios[name] = (function, kwargs, default)
+        return function
+    return register
+
+options = None
+
+
+def serve(tracks, playlists = 10):
+    """starts daap_server.py serving a synthetic library, and returns its
+    port. It runs in a process of its own, so that neither its memory nor
+    its work counts towards the scenario's, and it's asked for the
+    listing once first, so it isn't encoding while we measure."""
+    import socket, atexit
+    # find a free port for it
+    probe = socket.socket()
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'daap_server.py')
+    server = subprocess.Popen([sys.executable, script, '--port', str(port),
+        '--tracks', str(tracks), '--playlists', str(playlists)],
+        stderr = open(os.devnull, 'w'))
+    atexit.register(stop, server)
+    while True:
+        if server.poll() is not None:
+            raise RuntimeError('daap_server.py exited with %s' % server.returncode)
+        try:
+            socket.create_connection(('127.0.0.1', port)).close()
+            break
+        except socket.error:
+            time.sleep(0.1)
+    connection = DAAPClient()
+    connection.connect('127.0.0.1', port)
+    session = connection.login()
+    session.request('/databases/1/items', readFunc = len)
+    session.logout()
+    return port
+
+def stop(server):
+    if server.poll() is None:
+        server.terminate()
+        server.wait()
+
+def client(tracks = 1000, playlists = 10):
+    """a client, connected to whatever we're benchmarking against"""
+    if options.replay:
+        connection = DAAPClient(ReplayTransport(options.replay))
+        connection.connect(options.host, options.port)
+    elif options.record:
+        connection = DAAPClient(RecordingTransport(
+            HTTPTransport(options.host, options.port), options.record))
+        connection.connect(options.host, options.port)
+    elif options.host:
+        connection = DAAPClient()
+        connection.connect(options.host, options.port)
+    else:
+        connection = DAAPClient()
+        connection.connect('127.0.0.1', serve(tracks, playlists))
+    return connection
+
+def body(path, tracks = 1000):
+    """the raw response data for path from whatever we're benchmarking
+    against. '%s' in path is replaced by the id of the library."""
+    connection = client(tracks)
+    if path == '/content-codes':
+        return connection.request(path, {}, readFunc = str)
+    session = connection.login()
+    try:
+        if '%s' in path:
+            path = path % session.library().id
+        return session.request(path, {}, readFunc = str)
+    finally:
+        session.logout()
+
+
+@scenario('content-codes')
+def parse_content_codes():
+    data = body('/content-codes')
+    import daap
+    def run():
+        return daap.DAAPParseCodeTypes(DAAPClient().readResponse(data))
+    return run
+
+# decorators apply bottom up, so these are registered 10k first
+@scenario('parse-items-1m', default = False, tracks = 1000000)
+@scenario('parse-items-100k', tracks = 100000)
+@scenario('parse-items-10k', tracks = 10000)
+def parse_items(tracks):
+    data = body('/databases/%s/items', tracks)
+    def run():
+        return DAAPClient().readResponse(data)
+    return run
+
+# decoding a listing into columns, in as many processes as we have cores
+@scenario('parse-columns-1m', default = False, tracks = 1000000)
+@scenario('parse-columns-100k', tracks = 100000)
+def parse_columns(tracks):
+    import daap, multiprocessing
+    data = body('/databases/%s/items', tracks)
+    codes = daap.DAAPTrack.attrmap.values()
+    processes = multiprocessing.cpu_count()
+    def run():
+        return daap.listingColumns(data, codes, processes)
+    return run
+
+@scenario('attributes-10k', tracks = 10000)
+def attributes(tracks):
+    tracks = client(tracks).login().library().tracks()
+    def run():
+        for track in tracks:
+            track.id, track.name, track.artist, track.album, track.type, track.time, track.size
+    return run
+
+@scenario('rows-10k', tracks = 10000)
+def rows(tracks):
+    database = client(tracks).login().library()
+    def run():
+        return list(database.rows(('id', 'name', 'artist', 'album', 'type', 'time', 'size')))
+    return run
+
+@scenario('fingerprint-100k', tracks = 100000)
+def fingerprint(tracks):
+    import daap_fingerprints
+    data = body('/databases/%s/items', tracks)
+    def run():
+        return daap_fingerprints.listingFingerprints(data)
+    return run
+
+# two snapshots of the same library, with 1% of the tracks changed
+@scenario('diff-100k', tracks = 100000)
+def diff(tracks):
+    import daap_fingerprints
+    old = daap_fingerprints.listingFingerprints(body('/databases/%s/items', tracks))
+    new = daap_fingerprints.DAAPFingerprints(old.ids, [hash + (i % 100 == 0) for i, hash in enumerate(old.hashes)])
+    def run():
+        return old.diff(new)
+    return run
+
+@scenario('encode-10k', tracks = 10000)
+def encode(tracks):
+    response = DAAPClient().readResponse(body('/databases/%s/items', tracks))
+    def run():
+        return response.encode()
+    return run
+
+@scenario('playlist-fanout', tracks = 10000, playlists = 50)
+def playlist_fanout(tracks, playlists):
+    database = client(tracks, playlists).login().library()
+    def run():
+        results = list(database.snapshot_playlists(concurrency = 8))
+        for playlist, tracks, error in results:
+            if error: raise error
+        return results
+    return run
+
+@scenario('download', tracks = 100)
+def download(tracks):
+    import tempfile
+    track = client(tracks).login().library().tracks()[0]
+    descriptor, filename = tempfile.mkstemp(prefix = 'daap-bench-')
+    os.close(descriptor)
+    def run():
+        track.save(filename)
+        os.unlink(filename)
+    return run
+
+@scenario('connect')
+def connect():
+    def run():
+        client().login().logout()
+    return run
+
+
+def peak_rss():
+    """the peak resident set size of this process, in kilobytes"""
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss = rss // 1024
+    return rss
+
+def run_one(name):
+    """runs a scenario in this process, returns its results"""
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    function, kwargs, default = scenarios[name]
+    run = function(**kwargs)
+    gc.collect()
+    objects = len(gc.get_objects())
+    if tracemalloc:
+        tracemalloc.start()
+    start = time.time()
+    kept = run()
+    elapsed = time.time() - start
+    results = {'time': elapsed}
+    if tracemalloc:
+        results['peak_allocated_kb'] = tracemalloc.get_traced_memory()[1] // 1024
+        tracemalloc.stop()
+    gc.collect()
+    results['peak_rss_kb'] = peak_rss()
+    results['objects'] = len(gc.get_objects()) - objects
+    return results
+
+def run_isolated(name):
+    """runs a scenario in a fresh interpreter, so that peak RSS means
+    something, and returns its results - or None if it failed, when the
+    traceback has gone to stderr"""
+    args = [sys.executable, os.path.abspath(__file__), '--run-one', name]
+    for option in ('host', 'port', 'record', 'replay'):
+        value = getattr(options, option)
+        if value:
+            args += ['--%s' % option, str(value)]
+    child = subprocess.Popen(args, stdout = subprocess.PIPE)
+    output = child.communicate()[0]
+    if child.returncode != 0:
+        return None
+    return json.loads(output.strip().split('\n')[-1])
+
+def profile(name):
+    import cProfile, pstats
+    function, kwargs, default = scenarios[name]
+    run = function(**kwargs)
+    profiler = cProfile.Profile()
+    profiler.runcall(run)
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+
+def compare(results, baseline, threshold):
+    """prints how results differ from baseline, returns the names of the
+    scenarios that got more than 'threshold' slower"""
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]['time']
+        change = (result['time'] - before) / max(before, 1e-9)
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print "%-20s %9.4fs -> %9.4fs  %+6.1f%%%s" % (name, before, result['time'], change * 100, flag)
+    return regressions
+
+def main():
+    global options
+    parser = optparse.OptionParser(usage = '%prog [options] [scenario ...]')
+    parser.add_option('--list', action = 'store_true', help = 'list the scenarios')
+    parser.add_option('--repeat', type = 'int', default = 3,
+        help = 'run each scenario this many times, and keep the fastest')
+    parser.add_option('--save', help = 'write the results to this JSON file')
+    parser.add_option('--compare', help = 'compare the results to this JSON file')
+    parser.add_option('--threshold', type = 'float', default = 0.2,
+        help = 'fraction slower than the baseline that counts as a regression')
+    parser.add_option('--profile', action = 'store_true',
+        help = 'print a cProfile report for the scenarios instead')
+    parser.add_option('--host', help = 'benchmark against this server')
+    parser.add_option('--port', type = 'int', default = 3689)
+    parser.add_option('--record', help = 'record responses from --host into this directory')
+    parser.add_option('--replay', help = 'replay responses recorded in this directory')
+    parser.add_option('--run-one', help = optparse.SUPPRESS_HELP)
+    options, names = parser.parse_args()
+
+    if options.list:
+        for name, (function, kwargs, default) in scenarios.items():
+            print "%-20s%s" % (name, default and ' (default)' or '')
+        return
+
+    if options.run_one:
+        print json.dumps(run_one(options.run_one))
+        return
+
+    if not names:
+        names = [name for name, (function, kwargs, default) in scenarios.items() if default]
+    for name in names:
+        if name not in scenarios:
+            parser.error('no scenario called %s' % name)
+
+    if options.profile:
+        for name in names:
+            profile(name)
+        return
+
+    results = OrderedDict()
+    failed = []
+    for name in names:
+        runs = [run_isolated(name) for i in range(options.repeat)]
+        if None in runs:
+            print "%-20s FAILED" % name
+            failed.append(name)
+            continue
+        best = min(runs, key = lambda r: r['time'])
+        best['peak_rss_kb'] = max([r['peak_rss_kb'] for r in runs])
+        results[name] = best
+        print "%-20s %9.4fs  %8s KB peak  %+9d objects" % (
+            name, best['time'], best['peak_rss_kb'], best['objects'])
+
+    if options.save:
+        f = open(options.save, 'w')
+        try:
+            json.dump(results, f, indent = 2)
+        finally:
+            f.close()
+
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+        print
+        if compare(results, baseline, options.threshold):
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+#
+# A local broker that shares DAAP logins between processes. It holds one
+# connection and one session per server, and caches the content codes
+# and library listings until the server's revision changes. Local
+# programs talk to it over a Unix socket through BrokerClient, which is
+# a DAAPClient in every other way:
+#
+#   python daap_broker.py --socket /tmp/daap-broker.sock &
+#
+#   client = BrokerClient('/tmp/daap-broker.sock')
+#   client.connect('itunes.local')
+#   session = client.login()
+#   tracks = session.library().tracks()
+#   session.logout()        # the broker's session stays logged in
+#
+# The wire format is one request per connection: the client sends a line
+# of JSON, {"host", "port", "password", "path", "headers"}, and the broker
+# answers with a line of JSON, {"status", "headers"}, then the body, then
+# closes the connection.
+#
+
+import os, re, time
+import socket
+import threading
+import logging
+import json
+import SocketServer
+from urlparse import urlparse, parse_qs
+
+from daap import DAAPClient, DAAPTransport, DAAPObject, DAAPError
+
+__all__ = ['DAAPBroker', 'BrokerClient', 'BrokerTransport']
+
+log = logging.getLogger('daap.broker')
+
+
+class Upstream(object):
+    """The broker's connection and session to one server, and the
+    responses it has cached from it"""
+
+    # how often, at most, we ask the server whether it has changed before
+    # serving something from the cache
+    revalidate = 10
+
+    def __init__(self, host, port, password):
+        self.client = DAAPClient()
+        self.client.connect(host, port, password)
+        self.session = self.client.login()
+        self.revision = self.session.update()
+        self.checked = time.time()
+        self.checking = False
+        # (path, params) -> response data
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def nextRequest(self):
+        """bumps the request id, as a new download has to"""
+        self.lock.acquire()
+        self.client.request_id += 1
+        self.lock.release()
+
+    def cached(self, key):
+        """the cached response for key, or None. Every so often this asks
+        the server whether it's changed first; other requests meanwhile
+        are answered from the cache as it is."""
+        self.lock.acquire()
+        due = not self.checking and time.time() - self.checked > self.revalidate
+        if due:
+            self.checking = True
+        self.lock.release()
+        if due:
+            revision = None
+            try:
+                revision = self.session.update()
+            finally:
+                self.lock.acquire()
+                self.checking = False
+                self.checked = time.time()
+                if revision is not None and revision != self.revision:
+                    log.debug('Upstream: revision %s -> %s, dropping %s cached responses',
+                        self.revision, revision, len(self.cache))
+                    self.revision = revision
+                    self.cache.clear()
+                self.lock.release()
+        self.lock.acquire()
+        try:
+            return self.cache.get(key)
+        finally:
+            self.lock.release()
+
+    def store(self, key, data, revision):
+        """caches data, unless it was fetched before the revision changed"""
+        self.lock.acquire()
+        if revision == self.revision:
+            self.cache[key] = data
+        self.lock.release()
+
+
+class BrokerHandler(SocketServer.StreamRequestHandler):
+    """Answers one request from a BrokerTransport"""
+
+    # responses that are the same for everyone until the library changes
+    cacheable = re.compile(r'^/(content-codes|server-info|databases(/\d+/(items|containers(/\d+/items)?|groups|browse/\w+))?)$')
+    # responses to pass through as they come, without reading them all
+    streamed = re.compile(r'^/databases/\d+/items/\d+(\.\w+|/extra_data/.*)$')
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            url = urlparse(request['path'])
+            params = dict([(k, v[-1]) for k, v in parse_qs(url.query).items()])
+            params.pop('session-id', None)
+            key = (request['host'], request['port'], request.get('password'))
+            try:
+                self.answer(self.server.upstream(*key), url.path, params)
+            except DAAPError, e:
+                if e.status != 403:
+                    raise
+                # the server's forgotten our session - log in again
+                self.server.forget(key)
+                self.answer(self.server.upstream(*key), url.path, params)
+        except DAAPError, e:
+            log.debug('BrokerHandler: %s', e)
+            self.reply(e.status or 502, [('X-Broker-Error', str(e))])
+        except Exception, e:
+            log.exception('BrokerHandler: request failed')
+            self.reply(502, [('X-Broker-Error', str(e))])
+
+    def reply(self, status, headers = (), data = ''):
+        self.wfile.write(json.dumps({'status': status, 'headers': list(headers)}) + '\n')
+        self.wfile.write(data)
+
+    def answer(self, upstream, path, params):
+        if path == '/login':
+            # everyone shares the broker's session
+            self.reply(200, [('Content-Type', 'application/x-dmap-tagged')], DAAPObject('mlog', [
+                DAAPObject('mstt', 200),
+                DAAPObject('mlid', upstream.session.sessionid),
+            ]).encode())
+            return
+        if path == '/logout':
+            self.reply(204)
+            return
+
+        if self.streamed.match(path):
+            upstream.nextRequest()
+            response = upstream.session.connection.stream(path,
+                dict(params, **{'session-id': upstream.session.sessionid}))
+            try:
+                headers = [(k, v) for k, v in response.getheaders()
+                    if k.lower() in ('content-type', 'content-length', 'content-range')]
+                self.reply(response.status, headers)
+                data = response.read(64 * 1024)
+                while data:
+                    self.wfile.write(data)
+                    data = response.read(64 * 1024)
+            finally:
+                response.close()
+            return
+
+        key = None
+        revision = upstream.revision
+        if self.cacheable.match(path):
+            key = (path, tuple(sorted(params.items())))
+            data = upstream.cached(key)
+            if data is not None:
+                self.reply(200, [('Content-Type', 'application/x-dmap-tagged')], data)
+                return
+        if path in ('/content-codes', '/server-info'):
+            data = upstream.client.request(path, params, readFunc = lambda data: data)
+        else:
+            data = upstream.session.request(path, params, readFunc = lambda data: data)
+        if data is None:
+            self.reply(204)
+            return
+        if key is not None:
+            upstream.store(key, data, revision)
+        self.reply(200, [('Content-Type', 'application/x-dmap-tagged')], data)
+
+
+class DAAPBroker(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Listens on the Unix socket 'path' for BrokerClients, and makes their
+    requests with one shared session per server. The socket is only
+    accessible to the user running the broker."""
+
+    daemon_threads = True
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.unlink(path)
+        # the socket is made by bind(), so make sure it's never anyone
+        # else's, even for a moment
+        umask = os.umask(0177)
+        try:
+            SocketServer.UnixStreamServer.__init__(self, path, BrokerHandler)
+        finally:
+            os.umask(umask)
+        self.path = path
+        # (host, port, password) -> Upstream
+        self.upstreams = {}
+        # (host, port, password) -> a lock held while logging in to it
+        self.connecting = {}
+        self.lock = threading.Lock()
+
+    def upstream(self, host, port, password = None):
+        """the Upstream for a server, logging in to it the first time.
+        Only requests for the same server wait for the login."""
+        key = (host, port, password)
+        self.lock.acquire()
+        try:
+            upstream = self.upstreams.get(key)
+            if upstream is not None:
+                return upstream
+            connecting = self.connecting.setdefault(key, threading.Lock())
+        finally:
+            self.lock.release()
+
+        connecting.acquire()
+        try:
+            upstream = self.upstreams.get(key)
+            if upstream is None:
+                log.info('DAAPBroker: logging in to %s:%s', host, port)
+                upstream = Upstream(host, port, password)
+                self.lock.acquire()
+                self.upstreams[key] = upstream
+                self.lock.release()
+            return upstream
+        finally:
+            connecting.release()
+
+    def forget(self, key):
+        self.lock.acquire()
+        self.upstreams.pop(key, None)
+        self.lock.release()
+
+    def close(self):
+        """logs out of every server, and stops listening"""
+        for upstream in self.upstreams.values():
+            try:
+                upstream.session.logout()
+            except Exception:
+                pass
+        self.server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def serveInBackground(self):
+        thread = threading.Thread(target = self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+
+class BrokerResponse(object):
+    """a response read from the broker, like an httplib one"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('rb')
+        header = json.loads(self.file.readline())
+        self.status = header['status']
+        self.headers = dict([(k.lower(), v) for k, v in header['headers']])
+
+    def getheader(self, name, default = None):
+        return self.headers.get(name.lower(), default)
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self, size = -1):
+        return self.file.read(size)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class BrokerTransport(DAAPTransport):
+    """Sends requests for the server host:port through the broker
+    listening on the Unix socket 'path'"""
+
+    def __init__(self, path, hostname, port = 3689, password = None):
+        self.path = path
+        self.hostname = hostname
+        self.port = port
+        self.password = password
+
+    def request(self, path, headers, stats = None):
+        start = time.time()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+            if stats is not None:
+                stats.connect = time.time() - start
+            sock.sendall(json.dumps({'host': self.hostname, 'port': self.port,
+                'password': self.password, 'path': path, 'headers': headers}) + '\n')
+            return BrokerResponse(sock)
+        except:
+            sock.close()
+            raise
+
+
+class BrokerClient(DAAPClient):
+    """A DAAPClient that goes through the broker on the Unix socket
+    'path' instead of straight to the server"""
+
+    def __init__(self, path):
+        DAAPClient.__init__(self)
+        self.broker = path
+
+    def connect(self, hostname, port = 3689, password = None):
+        self.transport = BrokerTransport(self.broker, hostname, port, password)
+        DAAPClient.connect(self, hostname, port, password)
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('--socket', default = '/tmp/daap-broker.%s.sock' % os.getuid(),
+        help = 'the Unix socket to listen on')
+    parser.add_option('--revalidate', type = 'float', default = Upstream.revalidate,
+        help = 'seconds between checks that a cached library is still current')
+    parser.add_option('--debug', action = 'store_true', default = False)
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level = options.debug and logging.DEBUG or logging.INFO,
+        format = '%(asctime)s %(levelname)s %(message)s')
+    Upstream.revalidate = options.revalidate
+    broker = DAAPBroker(options.socket)
+    log.info('DAAPBroker: listening on %s', options.socket)
+    try:
+        broker.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broker.close()
+
+if __name__ == '__main__':
+    main()
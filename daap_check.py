@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#
+# Round-trips the corner cases of the test server through the client -
+# empty listings, empty deltas, long-polled updates - and fails if any of
+# them don't come back the way they went in. Run it after touching
+# daap_server.py:
+#
+#   python daap_check.py
+
+import sys, time
+
+from daap import DAAPClient, listingRows, listingDeleted
+from daap_server import DAAPServer, SyntheticLibrary
+
+checks = []
+
+def check(function):
+    """adds a check. Checks are passed a session on a server with its own
+    library, and raise AssertionError when they fail."""
+    checks.append(function)
+    return function
+
+def serve(library, **options):
+    server = DAAPServer(library, ('127.0.0.1', 0), **options)
+    server.serveInBackground()
+    connection = DAAPClient()
+    connection.connect('127.0.0.1', server.server_address[1])
+    return server, connection.login()
+
+@check
+def emptyPlaylist():
+    library = SyntheticLibrary(20, 0)
+    library.playlists.append((2, 'empty', []))
+    server, session = serve(library)
+    try:
+        playlist = [p for p in session.library().playlists() if p.id == 2][0]
+        assert playlist.count == 0, playlist.count
+        assert playlist.tracks() == []
+        assert list(playlist.rows()) == []
+    finally:
+        session.logout()
+        server.shutdown()
+
+@check
+def emptyLibrary():
+    server, session = serve(SyntheticLibrary(0, 0))
+    try:
+        database = session.library()
+        assert database.tracks() == []
+        assert list(database.rows()) == []
+    finally:
+        session.logout()
+        server.shutdown()
+
+@check
+def emptyDelta():
+    server, session = serve(SyntheticLibrary(20, 0))
+    try:
+        database = session.library()
+        revision = session.update()
+        rows, deleted = session.request('/databases/%s/items' % database.id,
+            {'meta': 'dmap.itemid', 'revision-number': revision, 'delta': revision},
+            readFunc = lambda data: (list(listingRows(data, ['miid'])), listingDeleted(data)))
+        assert rows == [], rows
+        assert deleted == [], deleted
+    finally:
+        session.logout()
+        server.shutdown()
+
+@check
+def longPoll():
+    server, session = serve(SyntheticLibrary(20, 0), update_timeout = 0.5)
+    try:
+        # the first update of a session is answered straight away...
+        start = time.time()
+        revision = session.request('/update', {'revision-number': 1}).getAtom('musr')
+        assert time.time() - start < 0.4, 'revision-number=1 waited'
+        # ...and one with the current revision waits for a change
+        start = time.time()
+        session.request('/update', {'revision-number': revision})
+        assert time.time() - start >= 0.4, 'revision-number=%s did not wait' % revision
+    finally:
+        session.logout()
+        server.shutdown()
+
+def main():
+    failed = False
+    for function in checks:
+        try:
+            function()
+        except Exception, e:
+            print "FAIL: %s: %s: %s" % (function.__name__, e.__class__.__name__, e)
+            failed = True
+        else:
+            print "ok: %s" % function.__name__
+    if failed:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
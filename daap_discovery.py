@@ -0,0 +1,657 @@
+# daap_discovery.py
+#
+# Finds DAAP shares on the local network with multicast DNS service
+# discovery, and gets a logged-in session ready for each one as soon as
+# it turns up, so that by the time someone picks a share it's connected.
+#
+# The mDNS browser is plain python. If it can't open a multicast socket
+# we fall back to avahi over D-Bus, if that's installed. MDNSResponder is
+# the other half - it answers queries for a single service, which is
+# enough for daap_server.py to advertise itself, and to test the browser
+# against without a network.
+#
+#   python daap_discovery.py
+#
+
+import socket, struct, time
+import threading
+import logging
+
+from daap import DAAPClient
+
+__all__ = ['DAAPDiscovery', 'DAAPShare', 'MDNSBrowser', 'AvahiBrowser', 'MDNSResponder']
+
+log = logging.getLogger('daap.discovery')
+
+MDNS_GROUP = ('224.0.0.251', 5353)
+DAAP_SERVICE = '_daap._tcp.local.'
+
+# record types
+TYPE_A = 1
+TYPE_PTR = 12
+TYPE_TXT = 16
+TYPE_SRV = 33
+TYPE_ANY = 255
+CLASS_IN = 1
+
+# the servers whose content codes we've read. They go in daap's
+# dmapCodeTypes, which every client shares, so once is enough.
+knownCodes = set()
+
+
+def encodeName(name):
+    """'a.b.local.' as DNS labels"""
+    data = ''
+    for label in name.rstrip('.').split('.'):
+        if isinstance(label, unicode):
+            label = label.encode('utf-8')
+        data += chr(len(label)) + label
+    return data + '\0'
+
+def decodeName(data, offset):
+    """reads a possibly compressed name, returns it and the offset after it"""
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        length = ord(data[offset])
+        if length & 0xc0 == 0xc0:
+            # a pointer to a name earlier in the packet
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 32:
+                raise ValueError('mDNS: name compression loop')
+            offset = struct.unpack('!H', data[offset:offset + 2])[0] & 0x3fff
+            continue
+        offset += 1
+        if length == 0:
+            break
+        labels.append(data[offset:offset + length])
+        offset += length
+    if end is None:
+        end = offset
+    return unicode('.'.join(labels) + '.', 'utf-8', 'replace'), end
+
+def encodeTXT(values):
+    data = ''
+    for key, value in sorted(values.items()):
+        entry = '%s=%s' % (key, value)
+        data += chr(len(entry)) + entry
+    return data or '\0'
+
+def decodeTXT(data):
+    values = {}
+    offset = 0
+    while offset < len(data):
+        length = ord(data[offset])
+        entry = data[offset + 1:offset + 1 + length]
+        offset += 1 + length
+        if entry:
+            key, sep, value = entry.partition('=')
+            values[key] = value
+    return values
+
+def buildQuery(questions, id = 0):
+    """a query packet asking for (name, type) pairs"""
+    data = struct.pack('!HHHHHH', id, 0, len(questions), 0, 0, 0)
+    for name, type in questions:
+        data += encodeName(name) + struct.pack('!HH', type, CLASS_IN)
+    return data
+
+def buildResponse(answers, additionals = (), id = 0, questions = ()):
+    """a response packet. Records are (name, type, ttl, rdata) with rdata
+    already encoded."""
+    data = struct.pack('!HHHHHH', id, 0x8400, len(questions), len(answers), 0, len(additionals))
+    for name, type in questions:
+        data += encodeName(name) + struct.pack('!HH', type, CLASS_IN)
+    for name, type, ttl, rdata in list(answers) + list(additionals):
+        data += encodeName(name) + struct.pack('!HHIH', type, CLASS_IN, ttl, len(rdata)) + rdata
+    return data
+
+def parsePacket(data):
+    """returns (id, is_response, questions, records) where questions are
+    (name, type) and records are (name, type, ttl, value). Values are
+    decoded for the types we care about: a name for PTR, (host, port) for
+    SRV, a dict for TXT and a dotted quad for A."""
+    id, flags, qdcount, ancount, nscount, arcount = struct.unpack('!HHHHHH', data[:12])
+    offset = 12
+    questions = []
+    for i in range(qdcount):
+        name, offset = decodeName(data, offset)
+        type, klass = struct.unpack('!HH', data[offset:offset + 4])
+        offset += 4
+        questions.append((name, type))
+
+    records = []
+    for i in range(ancount + nscount + arcount):
+        name, offset = decodeName(data, offset)
+        type, klass, ttl, length = struct.unpack('!HHIH', data[offset:offset + 10])
+        offset += 10
+        rdata = data[offset:offset + length]
+        if type == TYPE_PTR:
+            value = decodeName(data, offset)[0]
+        elif type == TYPE_SRV:
+            priority, weight, port = struct.unpack('!HHH', rdata[:6])
+            value = (decodeName(data, offset + 6)[0], port)
+        elif type == TYPE_TXT:
+            value = decodeTXT(rdata)
+        elif type == TYPE_A:
+            value = socket.inet_ntoa(rdata)
+        else:
+            value = rdata
+        offset += length
+        records.append((name, type, ttl, value))
+    return id, bool(flags & 0x8000), questions, records
+
+
+def multicastSocket(group = MDNS_GROUP):
+    """a UDP socket that can send to the mDNS group. We try to join the
+    group on port 5353 so we hear announcements and goodbyes too; if that
+    port can't be had, we use any port, and only hear direct replies."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, 'SO_REUSEPORT'):
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        except socket.error:
+            pass
+    try:
+        sock.bind(('', group[1]))
+        membership = struct.pack('4sl', socket.inet_aton(group[0]), socket.INADDR_ANY)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    except socket.error, e:
+        log.debug('mDNS: can\'t join %s:%s (%s), listening for direct replies only', group[0], group[1], e)
+        sock.close()
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.bind(('', 0))
+    sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 255)
+    return sock
+
+
+class MDNSBrowser(object):
+    """Browses for instances of 'service', calling added(name, host,
+    address, port, txt) when one is fully resolved and removed(name) when
+    it goes away, either with a goodbye or because its records expired.
+
+    'group' is where queries are sent. It's the mDNS multicast group
+    normally; pointing it at a unicast address and port - an
+    MDNSResponder, say - is handy for testing."""
+
+    def __init__(self, added, removed, service = DAAP_SERVICE, group = MDNS_GROUP, interval = 10):
+        self.added = added
+        self.removed = removed
+        self.service = service
+        self.group = group
+        self.interval = interval
+        self.running = False
+        if group == MDNS_GROUP:
+            self.socket = multicastSocket(group)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.bind(('', 0))
+        self.socket.settimeout(0.5)
+
+        # name -> expiry time, for PTR records
+        self.instances = {}
+        # instance -> ((host, port), expiry)
+        self.services = {}
+        # instance -> (txt dict, expiry)
+        self.texts = {}
+        # host -> (address, expiry)
+        self.addresses = {}
+        # instances we've told added() about, -> (host, address, port)
+        self.resolved = {}
+        # (name, type) -> when we last asked for it, so we ask for records
+        # we're missing at most once an interval
+        self.asked = {}
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target = self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.socket.close()
+
+    def query(self, questions):
+        try:
+            self.socket.sendto(buildQuery(questions), self.group)
+        except socket.error, e:
+            log.debug('mDNS: query failed: %s', e)
+
+    def run(self):
+        next_query = 0
+        while self.running:
+            now = time.time()
+            if now >= next_query:
+                self.query([(self.service, TYPE_PTR)])
+                next_query = now + self.interval
+            try:
+                data, address = self.socket.recvfrom(9000)
+            except socket.timeout:
+                data = None
+            except socket.error, e:
+                if not self.running:
+                    break
+                log.debug('mDNS: receive failed: %s', e)
+                data = None
+            if data:
+                try:
+                    self.handle(data)
+                except (ValueError, IndexError, struct.error), e:
+                    log.debug('mDNS: bad packet from %s: %s', address, e)
+            self.expire()
+
+    def handle(self, data):
+        id, response, questions, records = parsePacket(data)
+        if not response:
+            return
+        now = time.time()
+        lowered = self.service.lower()
+        for name, type, ttl, value in records:
+            # mDNS says a goodbye (ttl 0) should hang around for a second,
+            # but there's no point in that for a browser
+            expiry = ttl and now + ttl or 0
+            if type == TYPE_PTR and name.lower() == lowered:
+                self.instances[value] = expiry
+            elif type == TYPE_SRV:
+                self.services[name] = (value, expiry)
+            elif type == TYPE_TXT:
+                self.texts[name] = (value, expiry)
+            elif type == TYPE_A:
+                self.addresses[name.lower()] = (value, expiry)
+        self.resolve()
+
+    def resolve(self):
+        """tells added() about any instance we now know enough about, and
+        asks for the records we're still missing, unless we have lately"""
+        missing = []
+        for instance in self.instances.keys():
+            if instance in self.resolved:
+                continue
+            if instance not in self.services:
+                missing.append((instance, TYPE_SRV))
+                continue
+            (host, port), expiry = self.services[instance]
+            if host.lower() not in self.addresses:
+                missing.append((host, TYPE_A))
+                continue
+            address = self.addresses[host.lower()][0]
+            txt = self.texts.get(instance, ({}, 0))[0]
+            self.resolved[instance] = (host, address, port)
+            self.added(self.instanceName(instance), host, address, port, txt)
+        now = time.time()
+        missing = [question for question in missing
+            if self.asked.get(question, 0) + self.interval <= now]
+        if missing:
+            for question in missing:
+                self.asked[question] = now
+            self.query(missing)
+
+    def instanceName(self, instance):
+        """'Tom's Music._daap._tcp.local.' -> 'Tom's Music'"""
+        suffix = '.' + self.service
+        if instance.lower().endswith(suffix.lower()):
+            return instance[:-len(suffix)]
+        return instance
+
+    def expire(self):
+        now = time.time()
+        for table in (self.services, self.texts, self.addresses):
+            for key, (value, expiry) in table.items():
+                if expiry <= now:
+                    del table[key]
+        for instance, expiry in self.instances.items():
+            if expiry <= now:
+                del self.instances[instance]
+        for question, asked in self.asked.items():
+            if asked + self.interval <= now:
+                del self.asked[question]
+        for instance in self.resolved.keys():
+            if instance not in self.instances or instance not in self.services:
+                del self.resolved[instance]
+                self.instances.pop(instance, None)
+                self.removed(self.instanceName(instance))
+
+
+class AvahiBrowser(object):
+    """The same interface as MDNSBrowser, using avahi over D-Bus - for when
+    we can't do multicast ourselves. Needs the dbus, avahi and gobject
+    modules."""
+
+    def __init__(self, added, removed, service = DAAP_SERVICE):
+        import dbus, avahi, gobject
+        import dbus.glib
+        self.avahi = avahi
+        self.gobject = gobject
+        self.added = added
+        self.removed = removed
+        gobject.threads_init()
+        bus = dbus.SystemBus()
+        self.server = dbus.Interface(bus.get_object(avahi.DBUS_NAME, avahi.DBUS_PATH_SERVER),
+            avahi.DBUS_INTERFACE_SERVER)
+        path = self.server.ServiceBrowserNew(avahi.IF_UNSPEC, avahi.PROTO_UNSPEC,
+            service.rstrip('.').rsplit('.', 1)[0], 'local', dbus.UInt32(0))
+        self.browser = dbus.Interface(bus.get_object(avahi.DBUS_NAME, path),
+            avahi.DBUS_INTERFACE_SERVICE_BROWSER)
+        self.browser.connect_to_signal('ItemNew', self.itemNew)
+        self.browser.connect_to_signal('ItemRemove', self.itemRemove)
+        self.loop = gobject.MainLoop()
+
+    def itemNew(self, interface, protocol, name, type, domain, flags):
+        import dbus
+        result = self.server.ResolveService(interface, protocol, name, type, domain,
+            self.avahi.PROTO_INET, dbus.UInt32(0))
+        host, address, port, txt = result[5], result[7], result[8], result[9]
+        txt = decodeTXT(''.join([chr(len(entry)) + ''.join([chr(b) for b in entry]) for entry in txt]))
+        self.added(unicode(name), unicode(host), str(address), int(port), txt)
+
+    def itemRemove(self, interface, protocol, name, type, domain, flags):
+        self.removed(unicode(name))
+
+    def start(self):
+        self.thread = threading.Thread(target = self.loop.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.loop.quit()
+
+
+class MDNSResponder(object):
+    """Answers mDNS queries for one service instance - PTR, SRV, TXT and A.
+    By default it joins the mDNS group; pass another (address, port) to
+    run it as a local stub for testing. Sends a goodbye when stopped."""
+
+    def __init__(self, name, port, address = None, host = None, txt = None,
+            service = DAAP_SERVICE, bind = MDNS_GROUP, ttl = 120):
+        self.service = service
+        self.instance = '%s.%s' % (name, service)
+        self.port = port
+        self.host = host or '%s.local.' % socket.gethostname().split('.')[0]
+        self.address = address or socket.gethostbyname(socket.gethostname())
+        self.txt = txt or {'txtvers': '1'}
+        self.ttl = ttl
+        self.bind = bind
+        if bind == MDNS_GROUP:
+            self.socket = multicastSocket(bind)
+        else:
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.bind(bind)
+        self.socket.settimeout(0.5)
+        self.running = False
+
+    def records(self, ttl):
+        """(ptr, srv, txt, a) records for our instance"""
+        return (
+            (self.service, TYPE_PTR, ttl, encodeName(self.instance)),
+            (self.instance, TYPE_SRV, ttl, struct.pack('!HHH', 0, 0, self.port) + encodeName(self.host)),
+            (self.instance, TYPE_TXT, ttl, encodeTXT(self.txt)),
+            (self.host, TYPE_A, ttl, socket.inet_aton(self.address)),
+        )
+
+    def answer(self, questions):
+        """the records that answer questions, split into answers and
+        additionals"""
+        ptr, srv, txt, a = self.records(self.ttl)
+        answers = []
+        for name, type in questions:
+            name = name.lower()
+            if name == self.service.lower() and type in (TYPE_PTR, TYPE_ANY):
+                answers.append(ptr)
+            if name == self.instance.lower() and type in (TYPE_SRV, TYPE_ANY):
+                answers.append(srv)
+            if name == self.instance.lower() and type in (TYPE_TXT, TYPE_ANY):
+                answers.append(txt)
+            if name == self.host.lower() and type in (TYPE_A, TYPE_ANY):
+                answers.append(a)
+        if not answers:
+            return [], []
+        return answers, [r for r in (srv, txt, a) if r not in answers]
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target = self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        # announce ourselves
+        self.send(buildResponse(self.records(self.ttl)), MDNS_GROUP)
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        self.send(buildResponse(self.records(0)), MDNS_GROUP)
+        self.socket.close()
+
+    def send(self, data, address):
+        if self.bind != MDNS_GROUP and address == MDNS_GROUP:
+            # a local stub has no one to announce to
+            return
+        try:
+            self.socket.sendto(data, address)
+        except socket.error, e:
+            log.debug('mDNS: send to %s failed: %s', address, e)
+
+    def run(self):
+        while self.running:
+            try:
+                data, address = self.socket.recvfrom(9000)
+            except socket.timeout:
+                continue
+            except socket.error:
+                break
+            try:
+                id, response, questions, records = parsePacket(data)
+            except (ValueError, IndexError, struct.error), e:
+                log.debug('mDNS: bad packet from %s: %s', address, e)
+                continue
+            if response:
+                continue
+            answers, additionals = self.answer(questions)
+            if not answers:
+                continue
+            if address[1] == MDNS_GROUP[1]:
+                self.send(buildResponse(answers, additionals), MDNS_GROUP)
+            else:
+                # a 'legacy' querier, not on port 5353, gets a direct reply
+                # echoing its id and questions
+                self.send(buildResponse(answers, additionals, id, questions), address)
+
+
+class DAAPShare(object):
+    """A DAAP share that's been seen on the network. 'state' is one of
+    'found', 'connecting', 'ready', 'password' (it needs one, so we didn't
+    log in), 'failed' (see 'error') or 'gone'. Once it's 'ready', 'client'
+    and 'session' are a connected DAAPClient and a logged in DAAPSession."""
+
+    def __init__(self, name, host, address, port, txt):
+        self.name = name
+        self.host = host
+        self.address = address
+        self.port = port
+        self.txt = txt
+        self.state = 'found'
+        self.client = None
+        self.session = None
+        self.error = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return '<DAAPShare %r %s:%s %s>' % (self.name, self.address, self.port, self.state)
+
+    def needsPassword(self):
+        return self.txt.get('Password', '').lower() in ('1', 'true')
+
+    def warm(self, password = None):
+        """connects and logs in, unless it's password protected and we
+        don't have one. If the share is closed while we're logging in,
+        we log out again."""
+        self.lock.acquire()
+        try:
+            if self.state == 'gone':
+                return
+            if self.needsPassword() and password is None:
+                self.state = 'password'
+                self.ready.set()
+                return
+            self.state = 'connecting'
+        finally:
+            self.lock.release()
+        session = None
+        server = (self.address, self.port)
+        try:
+            client = DAAPClient()
+            # this fetches /server-info, and the content codes if we
+            # haven't already
+            client.connect(self.address, self.port, password,
+                content_codes = server not in knownCodes)
+            knownCodes.add(server)
+            session = client.login()
+        except Exception, e:
+            log.debug('DAAPShare: warming %r failed: %s', self.name, e)
+            client, error, state = None, e, 'failed'
+        else:
+            error, state = None, 'ready'
+
+        self.lock.acquire()
+        try:
+            gone = self.state == 'gone'
+            if not gone:
+                self.client, self.session = client, session
+                self.error, self.state = error, state
+        finally:
+            self.lock.release()
+        if gone and session is not None:
+            log.debug('DAAPShare: %r went while we logged in, logging out', self.name)
+            try:
+                session.logout()
+            except Exception:
+                pass
+        self.ready.set()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            session, self.session = self.session, None
+            self.state = 'gone'
+        finally:
+            self.lock.release()
+        if session is not None:
+            try:
+                session.logout()
+            except Exception:
+                pass
+        # anyone waiting for it to be ready has nothing more to wait for
+        self.ready.set()
+
+
+class DAAPDiscovery(object):
+    """A live registry of the DAAP shares on the network. Shares are
+    connected and logged in to as soon as they're found, unless 'warm' is
+    False. Every callable in 'listeners' is called with (event, share),
+    where event is 'added', 'ready' (warmed, whether or not that worked)
+    or 'removed'.
+
+        discovery = DAAPDiscovery()
+        discovery.start()
+        ...
+        for share in discovery.shares():
+            print share.name, share.state
+    """
+
+    def __init__(self, warm = True, passwords = None, browser = None, **browser_args):
+        self.warm = warm
+        self.passwords = passwords or {}
+        self.listeners = []
+        self.registry = {}
+        self.lock = threading.Lock()
+        self.browser = browser
+        self.browser_args = browser_args
+
+    def start(self):
+        if self.browser is None:
+            try:
+                self.browser = MDNSBrowser(self.added, self.removed, **self.browser_args)
+            except socket.error, e:
+                log.debug('DAAPDiscovery: no multicast (%s), trying avahi', e)
+                self.browser = AvahiBrowser(self.added, self.removed)
+        self.browser.start()
+
+    def stop(self):
+        self.browser.stop()
+        for share in self.shares():
+            share.close()
+
+    def shares(self):
+        self.lock.acquire()
+        try:
+            return self.registry.values()
+        finally:
+            self.lock.release()
+
+    def get(self, name):
+        return self.registry.get(name)
+
+    def notify(self, event, share):
+        for listener in self.listeners:
+            try:
+                listener(event, share)
+            except Exception:
+                log.exception('DAAPDiscovery: listener %r failed', listener)
+
+    def added(self, name, host, address, port, txt):
+        share = DAAPShare(name, host, address, port, txt)
+        self.lock.acquire()
+        try:
+            old = self.registry.get(name)
+            self.registry[name] = share
+        finally:
+            self.lock.release()
+        if old is not None:
+            old.close()
+        log.debug('DAAPDiscovery: found %r', share)
+        self.notify('added', share)
+        if self.warm:
+            def warm():
+                share.warm(self.passwords.get(name))
+                if share.state != 'gone':
+                    self.notify('ready', share)
+            thread = threading.Thread(target = warm)
+            thread.setDaemon(True)
+            thread.start()
+
+    def removed(self, name):
+        self.lock.acquire()
+        try:
+            share = self.registry.pop(name, None)
+        finally:
+            self.lock.release()
+        if share is not None:
+            log.debug('DAAPDiscovery: lost %r', share)
+            share.close()
+            self.notify('removed', share)
+
+
+if __name__ == '__main__':
+    def main():
+        logging.basicConfig(level=logging.DEBUG,
+                format='%(asctime)s %(levelname)s %(message)s')
+        def show(event, share):
+            print "%s: %r" % (event, share)
+            if event == 'ready' and share.state == 'ready':
+                print "  library is %r" % share.session.library().name
+        discovery = DAAPDiscovery()
+        discovery.listeners.append(show)
+        discovery.start()
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            discovery.stop()
+
+    main()
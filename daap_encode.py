@@ -0,0 +1,96 @@
+# daap_encode.py
+#
+# DAAPEncodeCache, which keeps encoded listing items so that the same
+# listing can be sent again without encoding it again. daap_server.py
+# uses one per library; pass one to DAAPObject.encode() to use it from
+# anywhere else.
+#
+
+from daap import DAAPObject, encodeContainer, _LRUCache
+
+__all__ = ['DAAPEncodeCache']
+
+
+class DAAPEncodeCache(object):
+    """Remembers encoded listing items, so that building a listing again is
+    a join of strings we already have rather than a walk of every atom.
+
+    Items are identified by a key - usually their dmap.itemid. Each field
+    of an item is encoded once, and kept as a fragment; the mlit for a
+    given set of fields is made by joining fragments under a new header,
+    and is kept as well. Call invalidate() when an item changes.
+
+    DAAPObject.encode() uses encodeObject() instead, which checks each
+    item's fields against what it encoded last time, so needs no
+    invalidate(). It keeps the max_objects items it used last."""
+
+    def __init__(self, max_objects = 100000):
+        self.fragments = {}
+        # key -> {codes: mlit}
+        self.items = {}
+        # (listing code, id) -> (fields, mlit), for encodeObject()
+        self.objects = _LRUCache(max_objects)
+        # the listing codes in objects
+        self.listings = set()
+
+    def item(self, key, codes, value):
+        """the encoded mlit for item 'key', holding the fields 'codes' in
+        that order. value(code) is called for any field that isn't already
+        encoded."""
+        codes = tuple(codes)
+        blobs = self.items.get(key)
+        if blobs is None:
+            blobs = self.items[key] = {}
+        blob = blobs.get(codes)
+        if blob is None:
+            fragments = self.fragments.get(key)
+            if fragments is None:
+                fragments = self.fragments[key] = {}
+            parts = []
+            for code in codes:
+                fragment = fragments.get(code)
+                if fragment is None:
+                    fragment = fragments[code] = DAAPObject(code, value(code)).encode()
+                parts.append(fragment)
+            blob = blobs[codes] = encodeContainer('mlit', ''.join(parts))
+        return blob
+
+    def encodeObject(self, object, listing = None):
+        """the encoded form of a parsed or built mlit DAAPObject, kept by
+        the code of the listing it's in and its dmap.itemid, and only
+        reused while its fields are the same. Returns None for items we
+        can't cache - ones with no id, or with containers inside."""
+        fields = []
+        id = None
+        for child in object.contains:
+            if child.type == 'c':
+                return None
+            fields.append((child.code, child.value))
+            if child.code == 'miid':
+                id = child.value
+        if id is None:
+            return None
+        fields = tuple(fields)
+        cached = self.objects.get((listing, id))
+        if cached is not None and cached[0] == fields:
+            return cached[1]
+        blob = encodeContainer('mlit', ''.join([DAAPObject(code, value).encode() for code, value in fields]))
+        self.listings.add(listing)
+        self.objects.put((listing, id), (fields, blob))
+        return blob
+
+    def listing(self, code, keys, codes, value, header = (), trailer = ''):
+        """a whole listing response: a 'code' container holding the (code,
+        value) atoms in header, then an mlcl of the items for keys, then
+        the already encoded trailer. value(key, code) is called for fields
+        that aren't encoded yet."""
+        items = ''.join([self.item(key, codes, lambda c, key = key: value(key, c)) for key in keys])
+        head = ''.join([DAAPObject(c, v).encode() for c, v in header])
+        return encodeContainer(code, head + encodeContainer('mlcl', items) + trailer)
+
+    def invalidate(self, key):
+        """forgets everything encoded for item 'key'"""
+        self.fragments.pop(key, None)
+        self.items.pop(key, None)
+        for listing in list(self.listings):
+            self.objects.discard((listing, key))
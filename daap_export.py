@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+#
+# Exports the metadata of a DAAP library - its tracks, playlists and
+# which tracks are in which playlist - as CSV, JSON Lines, SQLite or,
+# if pyarrow is installed, Parquet. Big responses are spooled to disk
+# (see DAAPClient.spool_threshold) and rows are read straight out of the
+# mapped file (see daap.listingRows) and written in batches, so neither
+# the response nor a DAAPTrack per track is held in memory.
+#
+#   python daap_export.py --format sqlite --output library.db itunes.local
+#
+# or from python:
+#
+#   export(session.library(), 'library.db', 'sqlite')
+#
+
+import os
+import itertools
+import optparse
+import logging
+
+from daap import DAAPClient, DAAPError
+
+__all__ = ['export', 'exporters', 'CSVExporter', 'JSONLinesExporter',
+    'SQLiteExporter', 'ParquetExporter']
+
+log = logging.getLogger('daap.export')
+
+# the track fields exported by default, from DAAPTrack.attrmap. daap_mirror
+# keeps the same ones, in this order.
+fields = ('id', 'name', 'artist', 'album', 'genre', 'year', 'tracknumber',
+    'type', 'time', 'size')
+
+# column types, for the formats that want them. Anything else is text.
+integers = set(['id', 'year', 'tracknumber', 'time', 'size', 'count',
+    'playlist', 'position', 'track'])
+
+
+def batches(rows, size):
+    """splits an iterable of rows into lists of at most 'size' rows"""
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+class Exporter(object):
+    """Writes tables of rows somewhere. Subclasses implement begin(), write()
+    and end() for one table at a time; table() feeds them batches."""
+
+    def __init__(self, path, batch_size = 1000):
+        self.path = path
+        self.batch_size = batch_size
+
+    def table(self, name, columns, rows):
+        """writes all of 'rows' as the table 'name', returns the row count"""
+        count = 0
+        self.begin(name, columns)
+        for batch in batches(rows, self.batch_size):
+            self.write(batch)
+            count += len(batch)
+        self.end()
+        log.debug('%s: wrote %s rows to %s', self.__class__.__name__, count, name)
+        return count
+
+    def begin(self, name, columns):
+        raise NotImplementedError
+
+    def write(self, batch):
+        raise NotImplementedError
+
+    def end(self):
+        pass
+
+    def close(self):
+        pass
+
+    def filename(self, name, extension):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        return os.path.join(self.path, '%s.%s' % (name, extension))
+
+
+class CSVExporter(Exporter):
+    """one CSV file per table, in the directory 'path'"""
+
+    def begin(self, name, columns):
+        import csv
+        self.file = open(self.filename(name, 'csv'), 'wb')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(columns)
+
+    def write(self, batch):
+        self.writer.writerows([[isinstance(value, unicode) and value.encode('utf-8') or value
+            for value in row] for row in batch])
+
+    def end(self):
+        self.file.close()
+
+
+class JSONLinesExporter(Exporter):
+    """one JSON Lines file per table, in the directory 'path'"""
+
+    def begin(self, name, columns):
+        import json
+        self.encoder = json.JSONEncoder()
+        self.columns = columns
+        self.file = open(self.filename(name, 'jsonl'), 'wb')
+
+    def write(self, batch):
+        encode = self.encoder.encode
+        columns = self.columns
+        self.file.write(''.join([encode(dict(zip(columns, row))) + '\n' for row in batch]))
+
+    def end(self):
+        self.file.close()
+
+
+class SQLiteExporter(Exporter):
+    """a table per table in the SQLite database 'path', replacing any that
+    are already there. Each table is written in one transaction."""
+
+    def __init__(self, path, batch_size = 1000):
+        Exporter.__init__(self, path, batch_size)
+        import sqlite3
+        self.db = sqlite3.connect(path)
+
+    def begin(self, name, columns):
+        self.db.execute('DROP TABLE IF EXISTS %s' % name)
+        self.db.execute('CREATE TABLE %s (%s)' % (name, ', '.join([
+            '%s %s' % (column, column in integers and 'INTEGER' or 'TEXT') for column in columns])))
+        self.insert = 'INSERT INTO %s VALUES (%s)' % (name, ', '.join(['?'] * len(columns)))
+
+    def write(self, batch):
+        self.db.executemany(self.insert, batch)
+
+    def end(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+
+
+class ParquetExporter(Exporter):
+    """one Parquet file per table, in the directory 'path'. Needs pyarrow."""
+
+    def __init__(self, path, batch_size = 10000):
+        Exporter.__init__(self, path, batch_size)
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            raise DAAPError('ParquetExporter: pyarrow is not installed')
+        self.pyarrow = pyarrow
+
+    def begin(self, name, columns):
+        pa = self.pyarrow
+        self.schema = pa.schema([(column, column in integers and pa.int64() or pa.string())
+            for column in columns])
+        self.writer = pa.parquet.ParquetWriter(self.filename(name, 'parquet'), self.schema)
+
+    def write(self, batch):
+        pa = self.pyarrow
+        arrays = [pa.array(list(values), type = field.type)
+            for values, field in zip(zip(*batch), self.schema)]
+        self.writer.write_table(pa.Table.from_arrays(arrays, schema = self.schema))
+
+    def end(self):
+        self.writer.close()
+
+
+exporters = {
+    'csv': CSVExporter,
+    'jsonl': JSONLinesExporter,
+    'sqlite': SQLiteExporter,
+    'parquet': ParquetExporter,
+}
+
+
+def playlistTracks(playlists, spool_threshold = None):
+    for playlist in playlists:
+        for position, (track,) in enumerate(playlist.rows(('id',), spool_threshold)):
+            yield playlist.id, position, track
+
+def export(database, path, format = 'csv', fields = fields, playlists = True,
+        batch_size = None, spool_threshold = 1024 * 1024):
+    """Exports the tracks of a DAAPDatabase to 'path' in the given format,
+    as the table 'tracks'. With playlists, the playlists go in the table
+    'playlists' and what's in them in 'playlist_tracks'; the base playlist,
+    which is the whole library, is left out. Returns a dict of table name
+    to row count.
+
+    Listings bigger than spool_threshold bytes are spooled to disk, unless
+    the connection spools at a lower threshold already. The whole listing
+    is still decoded at once if connection.parse_processes is set."""
+    if format not in exporters:
+        raise DAAPError('export: unknown format %s' % format)
+    threshold = database.session.connection.spool_threshold
+    if threshold is not None and spool_threshold is not None:
+        spool_threshold = min(threshold, spool_threshold)
+    if batch_size is None:
+        exporter = exporters[format](path)
+    else:
+        exporter = exporters[format](path, batch_size)
+    counts = {}
+    try:
+        counts['tracks'] = exporter.table('tracks', fields,
+            database.rows(fields, spool_threshold))
+        if playlists:
+            lists = [p for p in database.playlists() if not p.base]
+            counts['playlists'] = exporter.table('playlists', ('id', 'name', 'count'),
+                [(p.id, p.name, p.count) for p in lists])
+            counts['playlist_tracks'] = exporter.table('playlist_tracks',
+                ('playlist', 'position', 'track'), playlistTracks(lists, spool_threshold))
+    finally:
+        exporter.close()
+    return counts
+
+
+def main():
+    parser = optparse.OptionParser(usage = '%prog [options] host [port]')
+    parser.add_option('--format', default = 'csv', choices = sorted(exporters.keys()),
+        help = 'one of %s' % ', '.join(sorted(exporters.keys())))
+    parser.add_option('--output', default = 'export',
+        help = 'file (sqlite) or directory (the rest) to write to')
+    parser.add_option('--password')
+    parser.add_option('--fields', default = ','.join(fields),
+        help = 'comma separated track fields to export')
+    parser.add_option('--no-playlists', action = 'store_true')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('which server?')
+
+    connection = DAAPClient()
+    connection.connect(args[0], len(args) > 1 and int(args[1]) or 3689, options.password)
+    session = connection.login()
+    try:
+        counts = export(session.library(), options.output, options.format,
+            options.fields.split(','), not options.no_playlists)
+        for name, count in sorted(counts.items()):
+            print "%-16s %s rows" % (name, count)
+    finally:
+        session.logout()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,283 @@
+# daap_federation.py
+#
+# One library view over many DAAP servers. Every server's tracks are
+# merged into a single local index: each copy of a track gets an id
+# qualified with its server, identical tracks on different servers are
+# grouped together, and searching the whole lot is a dictionary lookup.
+#
+#   library = FederatedLibrary()
+#   library.add('alice.local')
+#   library.add('bob.local', 3689, 'secret')
+#   library.connect()
+#   for track in library.search('beatles help'):
+#       print track.artist, track.name, len(track.copies)
+#   library.download(track, 'help.mp3')
+#
+
+import re, bisect
+import threading
+import logging
+
+from daap import DAAPClient, DAAPTrack, DAAPError, daap_atoms, parallel
+
+__all__ = ['FederatedLibrary', 'FederatedTrack']
+
+log = logging.getLogger('daap.federation')
+
+
+def trackKey(track):
+    """what makes two copies of a track the same track"""
+    return (track.artist or u'', track.album or u'', track.name or u'', track.time or 0, track.size or 0)
+
+def words(text):
+    return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+
+class FederatedTrack(object):
+    """A distinct track, and every copy of it we know about. 'copies' maps
+    server-qualified ids to DAAPTracks."""
+
+    def __init__(self, key):
+        self.key = key
+        self.artist, self.album, self.name, self.time, self.size = key
+        self.copies = {}
+
+    def __repr__(self):
+        return '<FederatedTrack %r - %r, %s copies>' % (self.artist, self.name, len(self.copies))
+
+
+class FederatedServer(object):
+    """One of the servers in a FederatedLibrary, and the tracks we've
+    seen on it"""
+
+    def __init__(self, host, port = 3689, password = None):
+        self.host = host
+        self.port = port
+        self.password = password
+        self.name = '%s:%s' % (host, port)
+        self.client = None
+        self.session = None
+        self.database = None
+        self.revision = None
+        # track id -> DAAPTrack
+        self.tracks = {}
+        # downloads in progress, for picking the least busy server
+        self.active = 0
+        self.error = None
+
+    def qualify(self, track):
+        return '%s/%s/%s' % (self.name, self.database.id, track.id)
+
+
+class FederatedLibrary(object):
+    """Tracks from many DAAP servers, merged. Add servers with add(), then
+    connect(), and sync() whenever you like to pick up changes. Servers
+    that fail to connect or sync are left out, with the reason in their
+    'error', rather than failing everything."""
+
+    def __init__(self, concurrency = 8):
+        self.concurrency = concurrency
+        self.servers = {}
+        # dedupe key -> FederatedTrack
+        self.tracks = {}
+        # qualified id -> dedupe key
+        self.ids = {}
+        # word -> set of dedupe keys
+        self.words = {}
+        # the keys of words, sorted for prefix searches; None when words
+        # has changed since
+        self.sortedWords = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.tracks)
+
+    def add(self, host, port = 3689, password = None):
+        server = FederatedServer(host, port, password)
+        self.servers[server.name] = server
+        return server
+
+    def addSession(self, session, name = None):
+        """adds a server we're already logged in to - from daap_discovery,
+        say. The tracks are fetched on the next sync()."""
+        client = session.connection
+        server = FederatedServer(client.hostname, client.port, client.password)
+        if name:
+            server.name = name
+        server.client = client
+        server.session = session
+        server.database = session.library()
+        self.servers[server.name] = server
+        return server
+
+    def connect(self):
+        """connects to and logs in to every server that isn't already, all
+        at once, then syncs"""
+        def connect(server):
+            client = DAAPClient()
+            client.connect(server.host, server.port, server.password)
+            server.session = client.login()
+            server.client = client
+            server.database = server.session.library()
+        waiting = [s for s in self.servers.values() if s.session is None]
+        for server, result, error in parallel(connect, waiting, self.concurrency):
+            server.error = error
+        self.sync()
+
+    def disconnect(self):
+        for server in self.servers.values():
+            if server.session is not None:
+                try:
+                    server.session.logout()
+                except Exception:
+                    pass
+                server.session = None
+
+    def sync(self):
+        """brings every connected server's tracks up to date"""
+        ready = [s for s in self.servers.values() if s.session is not None]
+        for server, result, error in parallel(self.syncServer, ready, self.concurrency):
+            server.error = error
+
+    def syncServer(self, server):
+        """fetches what's changed on one server since we last looked, and
+        updates the index. Servers that support it send only the changes;
+        for the rest we get everything and work out the changes here."""
+        revision = server.session.update()
+        if server.revision is not None and revision == server.revision:
+            return
+        params = {'meta': daap_atoms}
+        if server.revision is not None:
+            params['revision-number'] = revision
+            params['delta'] = server.revision
+        response = server.session.request('/databases/%s/items' % server.database.id, params)
+
+        listing = response.getAtom('mlcl')
+        fetched = dict([(t.id, t) for t in
+            [DAAPTrack(server.database, atom) for atom in (listing and listing.contains or [])]])
+        deleted = response.getAtom('mudl')
+        if deleted is not None and server.revision is not None:
+            # a delta - fetched is only what changed
+            removed = [atom.value for atom in deleted.contains]
+            changed = fetched
+        else:
+            removed = [id for id in server.tracks if id not in fetched]
+            changed = dict([(id, track) for id, track in fetched.items()
+                if id not in server.tracks or trackKey(server.tracks[id]) != trackKey(track)])
+
+        self.lock.acquire()
+        try:
+            for id in removed:
+                track = server.tracks.pop(id, None)
+                if track is not None:
+                    self._unindex(server.qualify(track))
+            for id, track in changed.items():
+                old = server.tracks.get(id)
+                if old is not None:
+                    self._unindex(server.qualify(old))
+                server.tracks[id] = track
+                self._index(server.qualify(track), track)
+        finally:
+            self.lock.release()
+        server.revision = revision
+        log.debug('FederatedLibrary: %s at revision %s, %s changed, %s removed',
+            server.name, revision, len(changed), len(removed))
+
+    def _index(self, qualified, track):
+        key = trackKey(track)
+        federated = self.tracks.get(key)
+        if federated is None:
+            federated = self.tracks[key] = FederatedTrack(key)
+            for word in words(u'%s %s %s' % key[:3]):
+                if word not in self.words:
+                    self.words[word] = set()
+                    self.sortedWords = None
+                self.words[word].add(key)
+        federated.copies[qualified] = track
+        self.ids[qualified] = key
+
+    def _unindex(self, qualified):
+        key = self.ids.pop(qualified, None)
+        if key is None:
+            return
+        federated = self.tracks[key]
+        federated.copies.pop(qualified, None)
+        if not federated.copies:
+            del self.tracks[key]
+            for word in words(u'%s %s %s' % key[:3]):
+                keys = self.words.get(word)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self.words[word]
+                        self.sortedWords = None
+
+    def get(self, qualified):
+        """the FederatedTrack for a server-qualified track id"""
+        key = self.ids.get(qualified)
+        return key is not None and self.tracks.get(key) or None
+
+    def search(self, text):
+        """tracks with every word of text in their artist, album or name.
+        Words match whole words or their beginnings."""
+        terms = words(text)
+        if not terms:
+            return []
+        self.lock.acquire()
+        try:
+            if self.sortedWords is None:
+                self.sortedWords = sorted(self.words)
+            sortedWords = self.sortedWords
+            found = None
+            for term in terms:
+                # the words starting with term are together in sortedWords,
+                # term itself first if it's there
+                keys = set()
+                i = bisect.bisect_left(sortedWords, term)
+                while i < len(sortedWords) and sortedWords[i].startswith(term):
+                    keys |= self.words[sortedWords[i]]
+                    i += 1
+                found = keys if found is None else found & keys
+                if not found:
+                    return []
+            return [self.tracks[key] for key in found]
+        finally:
+            self.lock.release()
+
+    def serverFor(self, qualified):
+        return self.servers[qualified.rsplit('/', 2)[0]]
+
+    def download(self, track, filename):
+        """saves a FederatedTrack to filename, from whichever server that
+        has a copy is doing the fewest downloads right now. If that fails,
+        the other copies are tried in turn."""
+        self.lock.acquire()
+        untried = track.copies.keys()
+        self.lock.release()
+        error = DAAPError('FederatedLibrary: no connected server has %r' % (track,))
+        while True:
+            # pick a server and count the download in at once, so
+            # concurrent downloads spread out
+            self.lock.acquire()
+            try:
+                copies = sorted([(self.serverFor(q).active, q) for q in untried
+                    if self.serverFor(q).session is not None])
+                if not copies:
+                    break
+                qualified = copies[0][1]
+                untried.remove(qualified)
+                server = self.serverFor(qualified)
+                server.active += 1
+            finally:
+                self.lock.release()
+            try:
+                track.copies[qualified].save(filename)
+                return qualified
+            except Exception, e:
+                log.debug('FederatedLibrary: download from %s failed: %s', server.name, e)
+                error = e
+            finally:
+                self.lock.acquire()
+                server.active -= 1
+                self.lock.release()
+        raise error
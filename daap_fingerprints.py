@@ -0,0 +1,115 @@
+# daap_fingerprints.py
+#
+# Fingerprints of the items in a listing, for finding out what's changed
+# between two fetches of it from servers that don't send deltas. See
+# DAAPDatabase.fingerprints() and DAAPDatabase.changes().
+#
+#   before = database.fingerprints()
+#   ...
+#   added, removed, changed = before.diff(database.fingerprints())
+#
+
+import struct
+
+from daap import _listingBounds
+
+__all__ = ['DAAPFingerprints', 'listingFingerprints']
+
+
+def _fingerprintItems(data):
+    """yields (id, fingerprint, start, end) for each item in the listing of
+    a response that has an id"""
+    import zlib
+    bounds = _listingBounds(data)
+    if bounds is None:
+        return
+    unpack = struct.unpack_from
+    crc32 = zlib.crc32
+    position, end = bounds
+    while position < end:
+        code, length = unpack('!4sI', data, position)
+        position += 8
+        stop = position + length
+        if code == 'mlit':
+            child = position
+            while child < stop:
+                atom, size = unpack('!4sI', data, child)
+                if atom == 'miid':
+                    yield (unpack('!I', data, child + 8)[0],
+                        crc32(data[position:stop]) & 0xffffffff, position, stop)
+                    break
+                child += 8 + size
+        position = stop
+
+class DAAPFingerprints(object):
+    """A fingerprint for each item of a listing - the crc32 of its encoded
+    bytes - so that two fetches of the same listing can be compared without
+    decoding either. 'ids' and 'hashes' are arrays, sorted by id.
+
+    Fingerprints only compare between listings fetched with the same
+    'meta', from the same server: a different set or order of fields
+    changes every one."""
+
+    def __init__(self, ids = (), hashes = ()):
+        from array import array
+        self.ids = array('I', ids)
+        self.hashes = array('I', hashes)
+
+    @classmethod
+    def fromItems(cls, items):
+        """from (id, fingerprint) pairs, in any order"""
+        items = list(items)
+        if any(a[0] > b[0] for a, b in zip(items, items[1:])):
+            items.sort()
+        return cls([id for id, hash in items], [hash for id, hash in items])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    def get(self, id):
+        """the fingerprint of item id, or None"""
+        import bisect
+        i = bisect.bisect_left(self.ids, id)
+        if i < len(self.ids) and self.ids[i] == id:
+            return self.hashes[i]
+        return None
+
+    def diff(self, newer):
+        """(added, removed, changed) ids, going from this to the newer
+        DAAPFingerprints, each sorted"""
+        ids, hashes = self.ids, self.hashes
+        newIds, newHashes = newer.ids, newer.hashes
+        if ids == newIds:
+            # the usual case: the same items, a few of them changed
+            if hashes == newHashes:
+                return [], [], []
+            return [], [], [id for id, a, b in zip(ids, hashes, newHashes) if a != b]
+
+        # a merge join of the two
+        added, removed, changed = [], [], []
+        i, j = 0, 0
+        count, newCount = len(ids), len(newIds)
+        while i < count and j < newCount:
+            old, new = ids[i], newIds[j]
+            if old == new:
+                if hashes[i] != newHashes[j]:
+                    changed.append(old)
+                i += 1
+                j += 1
+            elif old < new:
+                removed.append(old)
+                i += 1
+            else:
+                added.append(new)
+                j += 1
+        removed.extend(ids[i:])
+        added.extend(newIds[j:])
+        return added, removed, changed
+
+def listingFingerprints(data):
+    """a DAAPFingerprints of the items in the listing of a response, read
+    straight out of the response data"""
+    return DAAPFingerprints.fromItems([(id, hash) for id, hash, start, end in _fingerprintItems(data)])
@@ -0,0 +1,195 @@
+# daap_mirror.py
+#
+# A local SQLite copy of the metadata of DAAP libraries: their databases,
+# tracks, playlists and which tracks are in which playlist. Syncing asks
+# the server for its revision first, and does nothing if it hasn't
+# changed; otherwise it applies just the changes, in one transaction.
+# After that, tools can query the mirror instead of the server.
+#
+#   mirror = DAAPMirror('music.db')
+#   mirror.sync(session.library())
+#   for track in mirror.search('beatles help'):
+#       print track['artist'], track['name']
+#   mirror.tracks(artist = u'The Beatles')
+#
+
+import threading
+import logging
+
+from daap import DAAPError, DAAPTrack, dmapCodeTypes, listingRows, listingDeleted
+from daap_export import fields, batches
+
+__all__ = ['DAAPMirror']
+
+log = logging.getLogger('daap.mirror')
+
+schema = """
+CREATE TABLE IF NOT EXISTS databases (
+    server TEXT, id INTEGER, name TEXT, revision INTEGER,
+    PRIMARY KEY (server, id));
+CREATE TABLE IF NOT EXISTS tracks (
+    server TEXT, database INTEGER, id INTEGER, name TEXT, artist TEXT,
+    album TEXT, genre TEXT, year INTEGER, tracknumber INTEGER, type TEXT,
+    time INTEGER, size INTEGER,
+    PRIMARY KEY (server, database, id));
+CREATE INDEX IF NOT EXISTS tracks_artist ON tracks (artist);
+CREATE INDEX IF NOT EXISTS tracks_album ON tracks (album);
+CREATE INDEX IF NOT EXISTS tracks_genre ON tracks (genre);
+CREATE TABLE IF NOT EXISTS playlists (
+    server TEXT, database INTEGER, id INTEGER, name TEXT, count INTEGER,
+    PRIMARY KEY (server, database, id));
+CREATE TABLE IF NOT EXISTS playlist_tracks (
+    server TEXT, database INTEGER, playlist INTEGER, position INTEGER,
+    track INTEGER);
+CREATE INDEX IF NOT EXISTS playlist_tracks_playlist
+    ON playlist_tracks (server, database, playlist, position);
+"""
+
+# a full text index over the tracks, kept up to date by triggers
+search_schema = """
+CREATE VIRTUAL TABLE IF NOT EXISTS tracks_search USING %s (
+    name, artist, album, content='tracks');
+CREATE TRIGGER IF NOT EXISTS tracks_search_insert AFTER INSERT ON tracks BEGIN
+    INSERT INTO tracks_search (rowid, name, artist, album)
+        VALUES (new.rowid, new.name, new.artist, new.album);
+END;
+CREATE TRIGGER IF NOT EXISTS tracks_search_delete AFTER DELETE ON tracks BEGIN
+    INSERT INTO tracks_search (tracks_search, rowid, name, artist, album)
+        VALUES ('delete', old.rowid, old.name, old.artist, old.album);
+END;
+"""
+
+
+class DAAPMirror(object):
+    """Mirrors DAAP databases into the SQLite database at 'path'. Search
+    uses FTS5 where sqlite has it, then FTS4, and falls back to LIKE.
+    'db' is the sqlite3 connection, for any queries of your own."""
+
+    batch_size = 1000
+
+    def __init__(self, path):
+        import sqlite3
+        self.db = sqlite3.connect(path, check_same_thread = False)
+        self.db.row_factory = sqlite3.Row
+        self.lock = threading.RLock()
+        self.db.executescript(schema)
+        # the track ids seen by a full sync
+        self.db.execute('CREATE TEMP TABLE seen (id INTEGER PRIMARY KEY)')
+        self.search_module = None
+        for module in ('fts5', 'fts4'):
+            try:
+                self.db.executescript(search_schema % module)
+                self.search_module = module
+                break
+            except sqlite3.OperationalError, e:
+                log.debug('DAAPMirror: no %s: %s', module, e)
+
+    def close(self):
+        self.db.close()
+
+    def server(self, database):
+        connection = database.session.connection
+        return '%s:%s' % (connection.hostname, connection.port)
+
+    def revision(self, server, database):
+        """the revision of a database we last synced, or None"""
+        row = self.db.execute('SELECT revision FROM databases WHERE server = ? AND id = ?',
+            (server, database)).fetchone()
+        return row and row[0]
+
+    def sync(self, database):
+        """Brings the mirror of a DAAPDatabase up to date. If the server's
+        revision hasn't changed since the last sync, that's all that
+        happens. Otherwise the changed tracks - or, from a server that
+        doesn't send deltas, all of them - are written in one transaction,
+        along with the playlists. Returns the revision."""
+        session = database.session
+        server = self.server(database)
+        revision = session.update()
+        last = self.revision(server, database.id)
+        if last == revision:
+            return revision
+
+        codes = [DAAPTrack.attrmap[field] for field in fields]
+        params = {'meta': ','.join([dmapCodeTypes[code][0] for code in codes])}
+        if last is not None:
+            params['revision-number'] = revision
+            params['delta'] = last
+        rows, deleted = session.request('/databases/%s/items' % database.id, params,
+            readFunc = lambda data: (listingRows(data, codes), listingDeleted(data)))
+        playlists = database.playlists()
+        members = [(playlist, list(playlist.rows(('id',)))) for playlist in playlists]
+
+        key = (server, database.id)
+        self.lock.acquire()
+        try:
+            # 'with' commits the transaction, or rolls it back
+            with self.db:
+                if deleted is None:
+                    # everything, so whatever we don't see again has gone
+                    self.db.execute('DELETE FROM seen')
+                for batch in batches(rows, self.batch_size):
+                    ids = [key + (row[0],) for row in batch]
+                    self.db.executemany('DELETE FROM tracks WHERE server = ? AND database = ? AND id = ?', ids)
+                    self.db.executemany('INSERT INTO tracks VALUES (?, ?, %s)' % ', '.join(['?'] * len(fields)),
+                        [key + row for row in batch])
+                    if deleted is None:
+                        self.db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(row[0],) for row in batch])
+                if deleted is None:
+                    self.db.execute('DELETE FROM tracks WHERE server = ? AND database = ? '
+                        'AND id NOT IN (SELECT id FROM seen)', key)
+                else:
+                    self.db.executemany('DELETE FROM tracks WHERE server = ? AND database = ? AND id = ?',
+                        [key + (id,) for id in deleted])
+
+                self.db.execute('DELETE FROM playlists WHERE server = ? AND database = ?', key)
+                self.db.execute('DELETE FROM playlist_tracks WHERE server = ? AND database = ?', key)
+                self.db.executemany('INSERT INTO playlists VALUES (?, ?, ?, ?, ?)',
+                    [key + (p.id, p.name, p.count) for p in playlists])
+                for playlist, tracks in members:
+                    self.db.executemany('INSERT INTO playlist_tracks VALUES (?, ?, ?, ?, ?)',
+                        [key + (playlist.id, position, id) for position, (id,) in enumerate(tracks)])
+
+                self.db.execute('INSERT OR REPLACE INTO databases VALUES (?, ?, ?, ?)',
+                    key + (database.name, revision))
+        finally:
+            self.lock.release()
+        log.debug('DAAPMirror: %s database %s now at revision %s', server, database.id, revision)
+        return revision
+
+    def tracks(self, **where):
+        """the mirrored tracks whose fields have the given values, eg
+        tracks(artist = u'Air', server = 'itunes.local:3689')"""
+        for name in where:
+            if name not in fields and name not in ('server', 'database'):
+                raise DAAPError('DAAPMirror: no track field %s' % name)
+        sql = 'SELECT * FROM tracks'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(['%s = ?' % name for name in where])
+        return self.db.execute(sql + ' ORDER BY artist, album, tracknumber',
+            where.values()).fetchall()
+
+    def playlist(self, server, database, playlist):
+        """the tracks in a mirrored playlist, in order"""
+        return self.db.execute('SELECT tracks.* FROM playlist_tracks JOIN tracks '
+            'ON tracks.server = playlist_tracks.server AND tracks.database = playlist_tracks.database '
+            'AND tracks.id = playlist_tracks.track '
+            'WHERE playlist_tracks.server = ? AND playlist_tracks.database = ? '
+            'AND playlist_tracks.playlist = ? ORDER BY position',
+            (server, database, playlist)).fetchall()
+
+    def search(self, text, limit = 100):
+        """tracks with every word of text in their name, artist or album"""
+        words = text.split()
+        if not words:
+            return []
+        if self.search_module:
+            # quote each word, so punctuation isn't taken as query syntax,
+            # and match anything starting with it
+            query = ' '.join(['"%s"*' % word.replace('"', '""') for word in words])
+            return self.db.execute('SELECT tracks.* FROM tracks_search '
+                'JOIN tracks ON tracks.rowid = tracks_search.rowid '
+                'WHERE tracks_search MATCH ? LIMIT ?', (query, limit)).fetchall()
+        sql = ' AND '.join(["(name || ' ' || artist || ' ' || album) LIKE ?"] * len(words))
+        return self.db.execute('SELECT * FROM tracks WHERE %s LIMIT ?' % sql,
+            ['%%%s%%' % word for word in words] + [limit]).fetchall()
@@ -0,0 +1,204 @@
+# daap_path.py
+#
+# Reading DMAP responses without building DAAPObjects. A DAAPPath is a
+# compiled path through a response that pulls the same fields out of
+# every container it reaches; listingRows and listingColumns run one
+# over a listing, the latter in several processes for big ones. daap.py
+# imports this the first time it needs it, so importing daap stays
+# cheap.
+#
+#   path = DAAPPath('adbs/mlcl/mlit/{miid,minm}')
+#   for id, name in path.rows(data):
+#       print id, name
+#
+
+import struct
+import threading
+
+from daap import DAAPObject, DAAPError, dmapCodeTypes, _RawItem, _decodeAtom, _listingBounds
+
+__all__ = ['DAAPPath', 'listingRows', 'listingColumns']
+
+
+class DAAPPath(object):
+    """A compiled path through a DMAP response, like
+    'adbs/mlcl/mlit/{miid,minm,asar}': the codes of the containers to go
+    down through from the top, '*' matching any, and then the fields to
+    take from each container reached. Running it yields a tuple of those
+    fields for each one, in a single pass - fields a container doesn't
+    have are None. Compile a path once and run it on any number of
+    responses, either the raw data (rows) or a parsed tree (objects)."""
+
+    def __init__(self, path):
+        self.path = path
+        parts = path.strip('/').split('/')
+        fields = parts.pop()
+        if fields.startswith('{') and fields.endswith('}'):
+            fields = fields[1:-1]
+        self.steps = parts
+        self.fields = [field.strip() for field in fields.split(',')]
+        for code in self.steps + self.fields:
+            if len(code) != 4 and code != '*' or code == '*' and code in self.fields:
+                raise DAAPError('DAAPPath: bad code %r in %r' % (code, path))
+        self.columns = dict([(field, i) for i, field in enumerate(self.fields)])
+
+    def __repr__(self):
+        return 'DAAPPath(%r)' % self.path
+
+    def rows(self, data, start = 0, end = None, types = None):
+        """runs the path over raw response data - a string or an mmap - or
+        the part of it from start to end. Container fields come back as
+        _RawItems. The fields' types come from dmapCodeTypes, unless
+        they're passed."""
+        if end is None:
+            end = len(data)
+        if types is None:
+            types = _codeTypes(self.fields)
+        if not self.steps:
+            return iter([self._fields(data, start, end, types)])
+        return self._rows(data, start, end, 0, types)
+
+    def _rows(self, data, position, end, depth, types):
+        unpack = struct.unpack_from
+        step = self.steps[depth]
+        last = depth == len(self.steps) - 1
+        while position < end:
+            code, length = unpack('!4sI', data, position)
+            position += 8
+            if code == step or step == '*':
+                if last:
+                    yield self._fields(data, position, position + length, types)
+                else:
+                    for row in self._rows(data, position, position + length, depth + 1, types):
+                        yield row
+            position += length
+
+    def _fields(self, data, position, end, types):
+        unpack = struct.unpack_from
+        columns = self.columns
+        row = [None] * len(columns)
+        while position < end:
+            code, size = unpack('!4sI', data, position)
+            position += 8
+            column = columns.get(code)
+            if column is not None and row[column] is None:
+                if types[column] == 'c':
+                    row[column] = _RawItem(data, position, position + size)
+                else:
+                    row[column] = _decodeAtom(types[column], data[position:position + size])
+            position += size
+        return tuple(row)
+
+    def objects(self, object):
+        """runs the path over a parsed DAAPObject tree. Container fields
+        come back as DAAPObjects."""
+        if not self.steps:
+            return iter([self._objectFields(object)])
+        return self._objects([object], 0)
+
+    def _objects(self, objects, depth):
+        step = self.steps[depth]
+        last = depth == len(self.steps) - 1
+        for object in objects:
+            if object.code == step or step == '*':
+                if last:
+                    yield self._objectFields(object)
+                else:
+                    for row in self._objects(getattr(object, 'contains', ()), depth + 1):
+                        yield row
+
+    def _objectFields(self, object):
+        columns = self.columns
+        row = [None] * len(columns)
+        for child in getattr(object, 'contains', ()):
+            column = columns.get(child.code)
+            if column is not None and row[column] is None:
+                if child.type == 'c':
+                    row[column] = child
+                else:
+                    row[column] = child.value
+        return tuple(row)
+
+    def first(self, source):
+        """the first tuple the path finds in source - raw data, or a parsed
+        tree - or a tuple of Nones if it finds nothing"""
+        if isinstance(source, DAAPObject):
+            rows = self.objects(source)
+        else:
+            rows = self.rows(source)
+        for row in rows:
+            return row
+        return (None,) * len(self.fields)
+
+def _codeTypes(codes):
+    return [dmapCodeTypes.get(code, (None, None))[1] for code in codes]
+
+def listingRows(data, codes):
+    """Yields a tuple of the values of 'codes' for each item (mlit) in the
+    listing (mlcl) of a response, read straight out of the response data
+    without building any DAAPObjects. Fields an item doesn't have are
+    None."""
+    return DAAPPath('*/mlcl/mlit/{%s}' % ','.join(codes)).rows(data)
+
+# the response being decoded by listingColumns, for worker processes that
+# are forked, and so can read it here rather than have it sent over
+_forkedData = None
+_forkedLock = threading.Lock()
+
+def _decodeColumns(args):
+    """decodes a run of mlit items into a tuple of values per code. Runs
+    in the worker processes of listingColumns."""
+    data, start, end, codes, types = args
+    if data is None:
+        data = _forkedData
+    columns = zip(*DAAPPath('mlit/{%s}' % ','.join(codes)).rows(data, start, end, types))
+    return columns or [()] * len(codes)
+
+def listingColumns(data, codes, processes = None, threshold = 8 * 1024 * 1024):
+    """Like listingRows, but returns the values of each code in a list of
+    columns. If the listing is bigger than 'threshold' bytes and
+    'processes' is more than one, it's split into runs of whole items,
+    which are decoded by a pool of that many processes; each sends back
+    its columns, and they're joined in order."""
+    bounds = _listingBounds(data)
+    if bounds is None:
+        return [[] for code in codes]
+    start, end = bounds
+    types = _codeTypes(codes)
+    if not processes or processes < 2 or end - start < threshold:
+        return [list(column) for column in _decodeColumns((data, start, end, codes, types))]
+
+    # cut the listing up on item boundaries, a few runs per process so a
+    # slow one doesn't hold up the rest
+    unpack = struct.unpack_from
+    step = (end - start) // (processes * 4) + 1
+    runs, first, position = [], start, start
+    while position < end:
+        position += 8 + unpack('!I', data, position + 4)[0]
+        if position - first >= step or position >= end:
+            runs.append((first, position))
+            first = position
+
+    import multiprocessing, os
+    global _forkedData
+    forked = os.name == 'posix'
+    if forked:
+        _forkedLock.acquire()
+        _forkedData = data
+        runs = [(None, a, b, codes, types) for a, b in runs]
+    else:
+        runs = [(data[a:b], 0, b - a, codes, types) for a, b in runs]
+    pool = multiprocessing.Pool(processes)
+    try:
+        columns = [[] for code in codes]
+        for run in pool.imap(_decodeColumns, runs):
+            for column, values in zip(columns, run):
+                column.extend(values)
+        pool.close()
+        return columns
+    finally:
+        pool.terminate()
+        pool.join()
+        if forked:
+            _forkedData = None
+            _forkedLock.release()
@@ -0,0 +1,233 @@
+# daap_scheduling.py
+#
+# Deciding when a DAAPClient sends its requests. A DAAPScheduler keeps
+# bulk work from getting in the way of interactive requests, and a
+# DAAPLimiter finds out how many requests at once the server can take.
+# Give a client either or both:
+#
+#   client = DAAPClient()
+#   client.scheduler = DAAPScheduler(limit = 4)
+#   client.limiter = DAAPLimiter()
+#
+
+import time
+import threading
+import logging
+from collections import OrderedDict, deque
+
+from daap import DAAPError
+
+__all__ = ['DAAPScheduler', 'DAAPLimiter']
+
+log = logging.getLogger('daap.scheduling')
+
+
+class DAAPScheduler(object):
+    """Decides which requests a DAAPClient sends when, so that background
+    work doesn't get in the way of a user waiting on an answer. Requests
+    are in one of three classes, highest priority first:
+
+    interactive -- logging in, updates and searches (a 'query' parameter)
+    metadata -- listings of databases, tracks and playlists
+    bulk -- track downloads and anything else streamed
+
+    At most 'limit' requests are in flight at once, and at most caps[class]
+    of each class, so with the default caps there's always a connection
+    left for interactive requests. Waiting requests of a class are taken
+    from each session in turn. Bulk downloads share 'bulk_bandwidth'
+    bytes per second between them, if it's set.
+
+    A streamed response holds its slot until it's closed, so a thread that
+    already holds all of a class's slots gets a DAAPError if it asks for
+    another, rather than waiting on itself for ever.
+
+        client.scheduler = DAAPScheduler(limit = 4, bulk_bandwidth = 2000000)
+    """
+
+    classes = ['interactive', 'metadata', 'bulk']
+    interactive = ['/login', '/logout', '/update', '/server-info', '/content-codes']
+
+    def __init__(self, limit = 4, caps = None, bulk_bandwidth = None):
+        self.limit = limit
+        self.caps = {'interactive': limit, 'metadata': 2, 'bulk': 1}
+        self.caps.update(caps or {})
+        self.bulk_bandwidth = bulk_bandwidth
+        self.active = dict([(name, 0) for name in self.classes])
+        # thread -> class -> slots it holds
+        self.held = {}
+        # class -> session -> tickets waiting, in the order the sessions
+        # take turns
+        self.waiting = dict([(name, OrderedDict()) for name in self.classes])
+        self.condition = threading.Condition()
+        # the bulk bandwidth token bucket
+        self.tokens = 0.0
+        self.filled = time.time()
+        self.bucket = threading.Lock()
+
+    def classify(self, r, params):
+        """the class of a request for path r"""
+        if r in self.interactive or 'query' in params:
+            return 'interactive'
+        return 'metadata'
+
+    def acquire(self, name, session = None):
+        """waits until a request of class 'name' can go, and counts it in.
+        Returns how long it waited."""
+        start = time.time()
+        ticket = object()
+        owner = threading.current_thread()
+        self.condition.acquire()
+        try:
+            held = self.held.get(owner, {})
+            if held.get(name, 0) >= self.caps[name] or sum(held.values()) >= self.limit:
+                raise DAAPError('DAAPScheduler: this thread already holds every %s slot; '
+                    'close its other responses first' % name)
+            self.waiting[name].setdefault(session, deque()).append(ticket)
+            while self._next() is not ticket:
+                self.condition.wait()
+            # that session goes to the back of the line
+            tickets = self.waiting[name].pop(session)
+            tickets.popleft()
+            if tickets:
+                self.waiting[name][session] = tickets
+            self.active[name] += 1
+            held = self.held.setdefault(owner, {})
+            held[name] = held.get(name, 0) + 1
+            # someone else may be able to go too
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        return time.time() - start
+
+    def _next(self):
+        """the ticket that should go next, if any can"""
+        if sum(self.active.values()) >= self.limit:
+            return None
+        for name in self.classes:
+            if self.waiting[name] and self.active[name] < self.caps[name]:
+                return self.waiting[name].itervalues().next()[0]
+        return None
+
+    def release(self, name, owner = None):
+        """counts a request of class 'name' out. 'owner' is the thread
+        that acquired it, if that isn't this one."""
+        if owner is None:
+            owner = threading.current_thread()
+        self.condition.acquire()
+        try:
+            self.active[name] -= 1
+            held = self.held.get(owner)
+            if held and held.get(name):
+                held[name] -= 1
+                if not sum(held.values()):
+                    del self.held[owner]
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def throttle(self, size):
+        """waits until 'size' more bytes of bulk data may be read"""
+        if not self.bulk_bandwidth:
+            return
+        self.bucket.acquire()
+        try:
+            now = time.time()
+            # allow a quarter of a second's burst
+            self.tokens = min(self.tokens + (now - self.filled) * self.bulk_bandwidth,
+                self.bulk_bandwidth / 4.0)
+            self.filled = now
+            self.tokens -= size
+            wait = -self.tokens / self.bulk_bandwidth
+        finally:
+            self.bucket.release()
+        if wait > 0:
+            time.sleep(wait)
+
+
+class DAAPLimiter(object):
+    """Learns how many requests at once a server can take, and keeps to
+    it. While we're using all of it, the limit goes up by about one for
+    every 'limit' requests that succeed, and is multiplied by 'decrease' when the server answers 503
+    or the time to first byte goes past 'latency_tolerance' times the
+    best recently seen - at most once every 'cooldown' seconds, so one
+    bad burst only counts once. Requests that get a 503 are retried up to
+    'retries' times, after a random wait of up to retry_delay * 2 **
+    attempt seconds (never more than max_delay).
+
+        client.limiter = DAAPLimiter()
+        ...
+        print client.limiter.limit, client.limiter.rejection_rate()
+    """
+
+    def __init__(self, initial = 4, minimum = 1, maximum = 64, decrease = 0.5,
+            latency_tolerance = 2.0, cooldown = 0.2, retries = 8, retry_delay = 0.05,
+            max_delay = 5.0, window = 100):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.max_delay = max_delay
+        self.active = 0
+        self.decreased = 0
+        # recent times to first byte, and whether recent answers were 503s
+        self.latencies = deque(maxlen = window)
+        self.rejections = deque(maxlen = window)
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        """waits for room under the limit. Returns how long that took."""
+        start = time.time()
+        self.condition.acquire()
+        try:
+            while self.active >= max(int(self.limit), 1):
+                self.condition.wait()
+            self.active += 1
+        finally:
+            self.condition.release()
+        return time.time() - start
+
+    def release(self, status = None, ttfb = None):
+        """counts a request out, adjusting the limit by how it went. The
+        status is None if it never got an answer."""
+        self.condition.acquire()
+        try:
+            # were we using all we're allowed?
+            busy = self.active >= int(self.limit)
+            self.active -= 1
+            if status is not None:
+                self.rejections.append(status == 503)
+            if status == 503:
+                self._decrease('503')
+            elif status is not None and ttfb is not None:
+                self.latencies.append(ttfb)
+                best = min(self.latencies)
+                if ttfb > best * self.latency_tolerance and ttfb - best > 0.005:
+                    self._decrease('time to first byte %.3fs' % ttfb)
+                elif busy:
+                    self.limit = min(self.limit + 1.0 / self.limit, self.maximum)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def _decrease(self, reason):
+        now = time.time()
+        if now - self.decreased < self.cooldown:
+            return
+        self.decreased = now
+        self.limit = max(self.limit * self.decrease, self.minimum)
+        log.debug('DAAPLimiter: %s, limit now %.1f', reason, self.limit)
+
+    def backoff(self, attempt):
+        """how long to wait before retry number 'attempt'"""
+        import random
+        return random.uniform(0, min(self.retry_delay * 2 ** attempt, self.max_delay))
+
+    def rejection_rate(self):
+        """the fraction of recent answers that were 503s"""
+        if not self.rejections:
+            return 0.0
+        return float(sum(self.rejections)) / len(self.rejections)
@@ -0,0 +1,1081 @@
+# daap_server.py
+#
+# A small DAAP server, built on the encoder and content code tables in
+# daap.py. It serves a 'library' object: DirectoryLibrary publishes the
+# music files in a directory, and SyntheticLibrary makes up one of any
+# size, so that the client can be load tested and benchmarked on one
+# machine, without an iTunes box.
+#
+# The server can also misbehave on purpose: gzip everything, pretend to be
+# on a slow link, refuse connections past a limit with a 503, or close the
+# connection after every request like Tangerine does.
+#
+#   python daap_server.py --directory ~/Music --name 'Office Music'
+#   python daap_server.py --port 3689 --tracks 100000 --playlists 50
+#
+
+import re, time, random, struct
+import threading
+import logging
+import BaseHTTPServer, SocketServer
+from urlparse import urlparse, parse_qs
+
+from daap import DAAPObject, dmapCodeTypes, dmapDataTypes, hash_v3, encodeContainer
+from daap_encode import DAAPEncodeCache
+
+__all__ = ['DAAPServer', 'DAAPRequestHandler', 'Library', 'SyntheticLibrary', 'DirectoryLibrary',
+    'RevisionJournal']
+
+log = logging.getLogger('daap.server')
+
+# the content codes we serve, as (code, name, type). The type is the
+# letter code used by daap.py - it's turned back into the DMAP type number
+# when we answer /content-codes.
+contentCodes = [
+    ('mccr', 'dmap.contentcodesresponse', 'c'),
+    ('mstt', 'dmap.status', 'ui'),
+    ('mdcl', 'dmap.dictionary', 'c'),
+    ('mcnm', 'dmap.contentcodesnumber', 's'),
+    ('mcna', 'dmap.contentcodesname', 's'),
+    ('mcty', 'dmap.contentcodestype', 'uh'),
+    ('msrv', 'dmap.serverinforesponse', 'c'),
+    ('mpro', 'dmap.protocolversion', 'v'),
+    ('apro', 'daap.protocolversion', 'v'),
+    ('minm', 'dmap.itemname', 's'),
+    ('msdc', 'dmap.databasescount', 'ui'),
+    ('mlog', 'dmap.loginresponse', 'c'),
+    ('mlid', 'dmap.sessionid', 'ui'),
+    ('mupd', 'dmap.updateresponse', 'c'),
+    ('musr', 'dmap.serverrevision', 'ui'),
+    ('muty', 'dmap.updatetype', 'ub'),
+    ('mtco', 'dmap.specifiedtotalcount', 'ui'),
+    ('mrco', 'dmap.returnedcount', 'ui'),
+    ('mlcl', 'dmap.listing', 'c'),
+    ('mlit', 'dmap.listingitem', 'c'),
+    ('mudl', 'dmap.deletedidlisting', 'c'),
+    ('miid', 'dmap.itemid', 'ui'),
+    ('mper', 'dmap.persistentid', 'ul'),
+    ('mimc', 'dmap.itemcount', 'ui'),
+    ('mctc', 'dmap.containercount', 'ui'),
+    ('avdb', 'daap.serverdatabases', 'c'),
+    ('adbs', 'daap.databasesongs', 'c'),
+    ('aply', 'daap.databaseplaylists', 'c'),
+    ('apso', 'daap.playlistsongs', 'c'),
+    ('abpl', 'daap.baseplaylist', 'ub'),
+    ('asal', 'daap.songalbum', 's'),
+    ('asar', 'daap.songartist', 's'),
+    ('asfm', 'daap.songformat', 's'),
+    ('asgn', 'daap.songgenre', 's'),
+    ('astm', 'daap.songtime', 'ui'),
+    ('assz', 'daap.songsize', 'ui'),
+    ('asyr', 'daap.songyear', 'uh'),
+    ('astn', 'daap.songtracknumber', 'uh'),
+    ('agal', 'daap.albumgrouping', 'c'),
+    ('agar', 'daap.artistgrouping', 'c'),
+    ('abro', 'daap.databasebrowse', 'c'),
+    ('abar', 'daap.browseartistlisting', 'c'),
+    ('abal', 'daap.browsealbumlisting', 'c'),
+    ('abgn', 'daap.browsegenrelisting', 'c'),
+]
+
+# the client side table is where DAAPObject looks up types, so make sure
+# everything we serve is in it.
+for code, name, type in contentCodes:
+    dmapCodeTypes.setdefault(code, (name, type))
+
+codeForName = dict([(name, code) for code, name, type in contentCodes])
+typeNumbers = dict([(type, number) for number, type in dmapDataTypes.items()])
+
+# the track fields a library provides, in the order we send them
+trackCodes = ['miid', 'minm', 'asar', 'asal', 'asgn', 'asfm', 'astm', 'assz', 'asyr', 'astn']
+
+
+class RevisionJournal(object):
+    """What changed in each revision of a library, so a client can be sent
+    just the changes since the revision it has. Entries are (revision,
+    changed ids, deleted ids), oldest first.
+
+    Once the entries hold more than 'limit' ids between them, the older
+    half are merged into one snapshot entry. A delta from a revision inside
+    a snapshot gets a few more ids than it needs, which does no harm. If
+    that isn't enough, the oldest entries are forgotten, and clients from
+    before them get the whole listing again."""
+
+    def __init__(self, revision = 1, limit = 10000):
+        self.limit = limit
+        self.entries = []
+        self.size = 0
+        # the oldest revision we can send a delta from
+        self.base = revision
+
+    def record(self, revision, changed = (), deleted = ()):
+        deleted = set(deleted)
+        changed = set(changed) - deleted
+        self.entries.append((revision, changed, deleted))
+        self.size += len(changed) + len(deleted)
+        if self.size > self.limit:
+            self.compact()
+
+    def merge(self, entries):
+        """one entry with the changes of entries, which are in order"""
+        changed, deleted = set(), set()
+        for revision, c, d in entries:
+            changed |= c
+            changed -= d
+            deleted |= d
+            deleted -= c
+        return entries[-1][0], changed, deleted
+
+    def compact(self):
+        if len(self.entries) > 1:
+            half = max(len(self.entries) // 2, 2)
+            self.entries[:half] = [self.merge(self.entries[:half])]
+            self.size = sum([len(c) + len(d) for r, c, d in self.entries])
+        # leave room, so we don't compact again on the next change
+        while self.size > self.limit // 2 and self.entries:
+            revision, changed, deleted = self.entries.pop(0)
+            self.size -= len(changed) + len(deleted)
+            self.base = revision
+        log.debug('RevisionJournal: compacted to %s entries, %s ids, deltas from revision %s',
+            len(self.entries), self.size, self.base)
+
+    def since(self, revision):
+        """(changed ids, deleted ids) since revision, or None if that's
+        too long ago"""
+        if revision < self.base:
+            return None
+        revision, changed, deleted = self.merge([(revision, set(), set())] +
+            [entry for entry in self.entries if entry[0] > revision])
+        return changed, deleted
+
+
+class Library(object):
+    """Something a DAAPServer can serve. Libraries are column stores: 'ids'
+    is the list of track ids, and 'columns' maps each of trackCodes to a
+    list of values, at the position 'index' gives for the track. 'playlists'
+    is a list of (id, name, [track ids]), and openTrack() returns the track
+    data.
+
+    Tracks are encoded to DMAP once, the first time they're asked for, and
+    kept in a DAAPEncodeCache, so big listings are mostly a join of strings
+    we already have. change() edits the library, and keeps a RevisionJournal
+    of what changed, so clients can ask for just that."""
+
+    name = 'Library'
+    # clients that don't know the revision yet send 1, so start past it,
+    # or their first long-poll would be answered straight away
+    revision = 2
+
+    # the most ids the journal holds before it's compacted
+    journal_limit = 10000
+
+    def _indexTracks(self):
+        """call once ids is filled in"""
+        self.index = dict([(id, i) for i, id in enumerate(self.ids)])
+        self.cache = DAAPEncodeCache()
+        # tracks deleted by change(). Their columns stay, so listings being
+        # sent while they went still work.
+        self.removed = set()
+        self.journal = RevisionJournal(self.revision, self.journal_limit)
+        self.lock = threading.Lock()
+        # a locked lock for each thread in waitForChange(), released when
+        # the revision changes or its time is up
+        self.waiters = set()
+        # (deadline, lock) for the waiters with a timeout, soonest first
+        self.deadlines = []
+        self.timer = None
+
+    def hasTrack(self, id):
+        return id in self.index and id not in self.removed
+
+    def change(self, tracks = {}, deleted = ()):
+        """Changes the library, as one new revision. 'tracks' maps track ids
+        to a dict of {code: value} for the fields that changed; tracks we
+        don't have are added, with anything not given left empty. 'deleted'
+        is a list of track ids to remove. Wakes everyone in waitForChange(),
+        and returns the new revision. Libraries that keep more than columns
+        for each track - DirectoryLibrary's paths, say - have to keep that
+        up to date themselves."""
+        deleted = set([id for id in deleted if self.hasTrack(id)])
+        self.lock.acquire()
+        try:
+            columns = self.columns
+            added = []
+            for id, values in tracks.items():
+                if not self.hasTrack(id):
+                    self.index[id] = len(columns['miid'])
+                    self.removed.discard(id)
+                    for code in trackCodes:
+                        empty = u'' if dmapCodeTypes[code][1] == 's' else 0
+                        columns[code].append(values.get(code, empty))
+                    columns['miid'][-1] = id
+                    added.append(id)
+                else:
+                    index = self.index[id]
+                    for code, value in values.items():
+                        if code != 'miid':
+                            columns[code][index] = value
+                self.cache.invalidate(id)
+            if deleted:
+                self.removed |= deleted
+                # new lists rather than changing the old, which might be
+                # being sent
+                self.ids = [id for id in self.ids if id not in deleted]
+                self.playlists = [(id, name, [i for i in ids if i not in deleted])
+                    for id, name, ids in self.playlists]
+                for id in deleted:
+                    self.cache.invalidate(id)
+            if added:
+                self.ids = self.ids + added
+            self.revision += 1
+            self.journal.record(self.revision, tracks.keys(), deleted)
+            for waiter in self.waiters:
+                waiter.release()
+            self.waiters = set()
+            self.deadlines = []
+            log.debug('Library: revision %s, %s tracks changed, %s deleted',
+                self.revision, len(tracks), len(deleted))
+            return self.revision
+        finally:
+            self.lock.release()
+
+    def changesSince(self, revision):
+        """(changed track ids, deleted track ids) since revision, or None
+        if the journal doesn't go back that far"""
+        self.lock.acquire()
+        try:
+            changes = self.journal.since(revision)
+        finally:
+            self.lock.release()
+        if changes is None:
+            return None
+        changed, deleted = changes
+        return sorted([id for id in changed if self.hasTrack(id)]), sorted(deleted)
+
+    def waitForChange(self, revision, timeout = None):
+        """waits until the library is past revision, or for timeout seconds,
+        and returns the current revision. Waiting threads are blocked on a
+        lock, not polling; one timer thread wakes those whose time is up."""
+        waiter = threading.Lock()
+        waiter.acquire()
+        self.lock.acquire()
+        try:
+            if self.revision > revision:
+                return self.revision
+            self.waiters.add(waiter)
+            if timeout is not None:
+                import heapq
+                heapq.heappush(self.deadlines, (time.time() + timeout, id(waiter), waiter))
+                if self.timer is None:
+                    self.timer = threading.Thread(target = self._expire)
+                    self.timer.setDaemon(True)
+                    self.timer.start()
+        finally:
+            self.lock.release()
+        waiter.acquire()
+        return self.revision
+
+    def _expire(self):
+        """releases the waiters whose timeout has passed, until there are
+        none left with one"""
+        import heapq
+        while True:
+            self.lock.acquire()
+            try:
+                now = time.time()
+                while self.deadlines and self.deadlines[0][0] <= now:
+                    deadline, key, waiter = heapq.heappop(self.deadlines)
+                    if waiter in self.waiters:
+                        self.waiters.discard(waiter)
+                        waiter.release()
+                if not self.deadlines:
+                    self.timer = None
+                    return
+                wait = self.deadlines[0][0] - now
+            finally:
+                self.lock.release()
+            # a deadline added meanwhile is never more than a second late
+            time.sleep(min(wait, 1.0))
+
+    def track(self, id, codes = trackCodes):
+        """the given fields of track 'id', as a list of (code, value)"""
+        index = self.index[id]
+        return [(code, self.columns[code][index]) for code in codes]
+
+    def value(self, id, code):
+        return self.columns[code][self.index[id]]
+
+    def encodedTrack(self, id, codes = trackCodes):
+        """the encoded mlit for track 'id', with the given fields"""
+        return self.cache.item(id, codes, lambda code: self.value(id, code))
+
+    def groups(self, code):
+        """the distinct non-empty values of a track field, sorted, with how
+        many tracks have each, as a list of (value, count). Worked out once
+        per revision."""
+        groups = getattr(self, '_groups', None)
+        if groups is None or groups[0] != self.revision:
+            groups = self._groups = (self.revision, {})
+        if code not in groups[1]:
+            values = self.columns[code]
+            if len(values) != len(self.ids):
+                # change() has left gaps
+                values = [self.value(id, code) for id in self.ids]
+            counts = {}
+            for value in values:
+                if value:
+                    counts[value] = counts.get(value, 0) + 1
+            groups[1][code] = sorted(counts.items(), key = lambda item: item[0].lower())
+        return groups[1][code]
+
+    def openTrack(self, id):
+        """returns a file-like object for the track data, and its size"""
+        raise NotImplementedError
+
+    def artwork(self, id):
+        """returns the cover art for track 'id' as (image data, content
+        type), or None if there isn't any"""
+        return None
+
+
+class SyntheticLibrary(Library):
+    """A made-up library of 'tracks' tracks and 'playlists' playlists. String
+    fields are between string_lengths[0] and string_lengths[1] characters
+    long, and a fraction 'unicode_ratio' of them have non-ascii characters
+    in. The same seed always gives the same library."""
+
+    def __init__(self, tracks = 10000, playlists = 10, string_lengths = (4, 40),
+            unicode_ratio = 0.1, seed = 0, name = 'Synthetic Library'):
+        self.name = name
+        rand = random.Random(seed)
+
+        def string(prefix):
+            length = rand.randint(*string_lengths)
+            text = (prefix + ' ' + 'x' * length)[:length]
+            if rand.random() < unicode_ratio:
+                text = u'\xe9\xf8\u2603' + text[3:]
+            return text
+
+        # a real library has many tracks per album, and many albums per
+        # artist, so repeat the same strings rather than making up new ones
+        artists = [string('artist %s' % i) for i in range(max(tracks // 50, 1))]
+        albums = [string('album %s' % i) for i in range(max(tracks // 10, 1))]
+        genres = [string('genre %s' % i) for i in range(20)]
+
+        self.ids = range(1, tracks + 1)
+        self.columns = {
+            'miid': list(self.ids),
+            'minm': [string('track %s' % i) for i in self.ids],
+            'asar': [rand.choice(artists) for i in self.ids],
+            'asal': [rand.choice(albums) for i in self.ids],
+            'asgn': [rand.choice(genres) for i in self.ids],
+            'asfm': ['mp3'] * tracks,
+            'astm': [rand.randint(60, 600) * 1000 for i in self.ids],
+            'assz': [rand.randint(1, 10) * 1024 * 1024 for i in self.ids],
+            'asyr': [rand.randint(1950, 2010) for i in self.ids],
+            'astn': [rand.randint(1, 20) for i in self.ids],
+        }
+        self._indexTracks()
+
+        self.playlists = []
+        for i in range(playlists):
+            size = rand.randint(0, min(tracks, 500))
+            self.playlists.append((i + 2, string('playlist %s' % i), sorted(rand.sample(self.ids, size))))
+
+    def openTrack(self, id):
+        size = self.columns['assz'][self.index[id]]
+        return SyntheticFile(size, id), size
+
+    def artwork(self, id):
+        # not a real image, but different for every album
+        album = self.columns['asal'][self.index[id]]
+        return '\x89PNG\r\n\x1a\n' + album.encode('utf-8') * 64, 'image/png'
+
+
+class SyntheticFile(object):
+    """size bytes of junk, made up as it's read"""
+
+    def __init__(self, size, seed = 0):
+        self.size = size
+        self.remaining = size
+        self.block = struct.pack('!I', seed) * 16 * 1024
+
+    def seek(self, offset):
+        self.remaining = max(self.size - offset, 0)
+
+    def read(self, size):
+        size = min(size, self.remaining, len(self.block))
+        self.remaining -= size
+        return self.block[:size]
+
+    def close(self):
+        pass
+
+
+class DirectoryLibrary(Library):
+    """The music files under 'path', scanned once. Tags are read with
+    mutagen, if it's installed. Otherwise - or where a file has no tags -
+    they're guessed from an 'Artist/Album/01 Title.mp3' layout. Each .m3u
+    file found becomes a playlist."""
+
+    extensions = ['mp3', 'm4a', 'aac', 'm4p', 'ogg', 'flac', 'wav', 'aif', 'aiff']
+
+    def __init__(self, path, name = None):
+        import os
+        self.path = os.path.abspath(path)
+        self.name = name or os.path.basename(self.path.rstrip(os.sep)) or 'Library'
+        self.ids = []
+        self.paths = []
+        self.columns = dict([(code, []) for code in trackCodes])
+        lists = []
+
+        for directory, subdirectories, filenames in os.walk(self.path):
+            subdirectories.sort()
+            for filename in sorted(filenames):
+                filename = os.path.join(directory, filename)
+                extension = os.path.splitext(filename)[1][1:].lower()
+                if extension == 'm3u':
+                    lists.append(filename)
+                elif extension in self.extensions:
+                    try:
+                        self._addTrack(filename, extension)
+                    except (OSError, IOError), e:
+                        log.debug('DirectoryLibrary: skipping %s: %s', filename, e)
+        self._indexTracks()
+        log.info('DirectoryLibrary: %s tracks in %s', len(self.ids), self.path)
+
+        ids = dict([(trackPath, id) for id, trackPath in zip(self.ids, self.paths)])
+        self.playlists = []
+        for filename in lists:
+            tracks = [ids[trackPath] for trackPath in self._readPlaylist(filename) if trackPath in ids]
+            name = os.path.splitext(os.path.basename(filename))[0]
+            self.playlists.append((len(self.playlists) + 2, name, tracks))
+
+    def _addTrack(self, filename, extension):
+        import os
+        tags = self._guessTags(filename)
+        tags.update(self._readTags(filename))
+        id = len(self.ids) + 1
+        self.ids.append(id)
+        self.paths.append(filename)
+        columns = self.columns
+        columns['miid'].append(id)
+        columns['minm'].append(tags.get('title', u''))
+        columns['asar'].append(tags.get('artist', u''))
+        columns['asal'].append(tags.get('album', u''))
+        columns['asgn'].append(tags.get('genre', u''))
+        columns['asfm'].append(extension)
+        columns['astm'].append(tags.get('time', 0))
+        columns['assz'].append(os.path.getsize(filename))
+        columns['asyr'].append(tags.get('year', 0))
+        columns['astn'].append(tags.get('tracknumber', 0))
+
+    def _decode(self, text):
+        if isinstance(text, unicode):
+            return text
+        try:
+            return unicode(text, 'utf-8')
+        except UnicodeDecodeError:
+            return unicode(text, 'latin-1')
+
+    def _guessTags(self, filename):
+        import os
+        relative = os.path.relpath(filename, self.path)
+        parts = [self._decode(part) for part in relative.split(os.sep)]
+        title = os.path.splitext(parts[-1])[0]
+        tags = {}
+        match = re.match(r'(\d+)[\s.-]+(.*)$', title)
+        if match:
+            tags['tracknumber'] = int(match.group(1)) % 65536
+            title = match.group(2)
+        tags['title'] = title
+        if len(parts) >= 2:
+            tags['album'] = parts[-2]
+        if len(parts) >= 3:
+            tags['artist'] = parts[-3]
+        return tags
+
+    def _readTags(self, filename):
+        try:
+            import mutagen
+        except ImportError:
+            return {}
+        try:
+            audio = mutagen.File(filename, easy = True)
+        except Exception, e:
+            log.debug('DirectoryLibrary: can\'t read tags from %s: %s', filename, e)
+            return {}
+        if audio is None:
+            return {}
+
+        tags = {}
+        def first(name):
+            values = audio.get(name) if audio.tags is not None else None
+            return values and self._decode(values[0]) or None
+        for name in ('title', 'artist', 'album', 'genre'):
+            if first(name):
+                tags[name] = first(name)
+        for name, tag in (('year', 'date'), ('tracknumber', 'tracknumber')):
+            match = re.match(r'\d+', first(tag) or '')
+            if match:
+                tags[name] = int(match.group(0)) % 65536
+        if getattr(audio, 'info', None) and getattr(audio.info, 'length', None):
+            tags['time'] = int(audio.info.length * 1000)
+        return tags
+
+    def _readPlaylist(self, filename):
+        import os
+        directory = os.path.dirname(filename)
+        f = open(filename)
+        try:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith('#'):
+                    yield os.path.normpath(os.path.join(directory, line))
+        finally:
+            f.close()
+
+    def openTrack(self, id):
+        index = self.index[id]
+        return open(self.paths[index], 'rb'), self.columns['assz'][index]
+
+    # image files that hold the cover of the album in their directory
+    covers = [('cover.jpg', 'image/jpeg'), ('folder.jpg', 'image/jpeg'),
+        ('front.jpg', 'image/jpeg'), ('cover.png', 'image/png')]
+
+    def artwork(self, id):
+        import os
+        directory = os.path.dirname(self.paths[self.index[id]])
+        for name, type in self.covers:
+            filename = os.path.join(directory, name)
+            if os.path.isfile(filename):
+                f = open(filename, 'rb')
+                try:
+                    return f.read(), type
+                finally:
+                    f.close()
+        return None
+
+
+class DAAPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers the DAAP requests for self.server.library"""
+
+    server_version = 'PythonDaap'
+
+    # every response has a Content-Length, so connections can be kept
+    # alive unless the server is pretending to be Tangerine
+    protocol_version = 'HTTP/1.1'
+
+    # (regular expression, method name) for everything we understand
+    routes = [
+        (r'^/server-info$', 'serverInfo'),
+        (r'^/content-codes$', 'contentCodes'),
+        (r'^/login$', 'login'),
+        (r'^/logout$', 'logout'),
+        (r'^/update$', 'update'),
+        (r'^/databases$', 'databases'),
+        (r'^/databases/1/items$', 'items'),
+        (r'^/databases/1/containers$', 'containers'),
+        (r'^/databases/1/containers/(\d+)/items$', 'containerItems'),
+        (r'^/databases/1/items/(\d+)\.\w+$', 'download'),
+        (r'^/databases/1/items/(\d+)/extra_data/artwork$', 'artwork'),
+        (r'^/databases/1/groups$', 'groups'),
+        (r'^/databases/1/browse/(artists|albums|genres)$', 'browse'),
+    ]
+    routes = [(re.compile(pattern), name) for pattern, name in routes]
+
+    # these don't need a session
+    public = ['serverInfo', 'contentCodes', 'login']
+
+    def log_message(self, format, *args):
+        log.debug(format, *args)
+
+    def do_GET(self):
+        server = self.server
+        if server.one_request_per_connection:
+            self.close_connection = 1
+
+        if not server.admit():
+            self.sendStatus(503)
+            return
+        try:
+            if server.latency:
+                time.sleep(server.latency)
+            self.route()
+        finally:
+            server.release()
+
+    def route(self):
+        url = urlparse(self.path)
+        self.params = dict([(k, v[-1]) for k, v in parse_qs(url.query).items()])
+
+        if self.server.validate and not self.validRequest():
+            self.sendStatus(403)
+            return
+
+        for pattern, name in self.routes:
+            match = pattern.match(url.path)
+            if not match:
+                continue
+            if name not in self.public and not self.server.hasSession(self.params.get('session-id')):
+                self.sendStatus(403)
+                return
+            getattr(self, name)(*[int(g) if g.isdigit() else g for g in match.groups()])
+            return
+        self.sendStatus(404)
+
+    def validRequest(self):
+        """checks Client-DAAP-Validation the same way iTunes does"""
+        try:
+            request_id = int(self.headers.get('Client-DAAP-Request-ID', 0))
+        except ValueError:
+            return False
+        return self.headers.get('Client-DAAP-Validation') == hash_v3(self.path, 2, request_id)
+
+    def sendStatus(self, status):
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+
+    def sendData(self, data):
+        """sends an encoded DMAP response, compressed if the server is set
+        up to and the client asked for it"""
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-dmap-tagged')
+        if self.server.gzip and 'gzip' in self.headers.get('Accept-Encoding', ''):
+            import zlib
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            data = compressor.compress(data) + compressor.flush()
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(data)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.write(data)
+
+    def sendObject(self, object):
+        self.sendData(object.encode())
+
+    def write(self, data):
+        """writes to the client, no faster than the server's bandwidth"""
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(data)
+            return
+        # send a tenth of a second's worth at a time
+        step = max(int(bandwidth / 10), 1)
+        for start in range(0, len(data), step):
+            chunk = data[start:start + step]
+            self.wfile.write(chunk)
+            self.wfile.flush()
+            time.sleep(float(len(chunk)) / bandwidth)
+
+    def metaCodes(self):
+        """the track fields asked for in the 'meta' parameter"""
+        meta = self.params.get('meta')
+        if not meta:
+            return trackCodes
+        codes = [codeForName.get(name) for name in meta.split(',')]
+        return [code for code in trackCodes if code in codes] or ['miid']
+
+    def listing(self, code, items):
+        return DAAPObject(code, [
+            DAAPObject('mstt', 200),
+            DAAPObject('muty', 0),
+            DAAPObject('mtco', len(items)),
+            DAAPObject('mrco', len(items)),
+            DAAPObject('mlcl', items),
+        ])
+
+    def sendTracks(self, code, ids, deleted = None, total = None):
+        """sends a listing of tracks. Rather than building a tree of objects
+        for every track, we join the tracks' encoded blobs. With 'deleted',
+        it's a delta: ids are the tracks that changed, and deleted goes in
+        an mudl after them."""
+        library = self.server.library
+        trailer = ''
+        if deleted is not None:
+            trailer = encodeContainer('mudl', ''.join([DAAPObject('miid', id).encode() for id in deleted]))
+        self.sendData(library.cache.listing(code, ids, self.metaCodes(), library.value,
+            (('mstt', 200), ('muty', deleted is not None and 1 or 0),
+                ('mtco', len(ids) if total is None else total), ('mrco', len(ids))), trailer))
+
+    def serverInfo(self):
+        self.sendObject(DAAPObject('msrv', [
+            DAAPObject('mstt', 200),
+            DAAPObject('mpro', '2.0'),
+            DAAPObject('apro', '3.0'),
+            DAAPObject('minm', self.server.library.name),
+            DAAPObject('msdc', 1),
+        ]))
+
+    def contentCodes(self):
+        dictionaries = [DAAPObject('mdcl', [
+            DAAPObject('mcnm', code),
+            DAAPObject('mcna', name),
+            DAAPObject('mcty', typeNumbers[type]),
+        ]) for code, name, type in contentCodes]
+        self.sendObject(DAAPObject('mccr', [DAAPObject('mstt', 200)] + dictionaries))
+
+    def login(self):
+        self.sendObject(DAAPObject('mlog', [
+            DAAPObject('mstt', 200),
+            DAAPObject('mlid', self.server.newSession()),
+        ]))
+
+    def logout(self):
+        self.server.endSession(self.params.get('session-id'))
+        self.sendStatus(204)
+
+    def update(self):
+        """answers with the library's revision straight away - unless the
+        client sends the revision-number it already has, when we wait
+        until there's a newer one, or the server's update_timeout. Clients
+        that don't know the revision yet send 1."""
+        library = self.server.library
+        revision = self.params.get('revision-number', '')
+        if revision.isdigit() and int(revision) > 1 and int(revision) >= library.revision:
+            # waiting clients don't count towards max_connections
+            self.server.release()
+            try:
+                library.waitForChange(int(revision), self.server.update_timeout)
+            finally:
+                self.server.admit(limit = False)
+        self.sendObject(DAAPObject('mupd', [
+            DAAPObject('mstt', 200),
+            DAAPObject('musr', library.revision),
+        ]))
+
+    def databases(self):
+        library = self.server.library
+        self.sendObject(self.listing('avdb', [DAAPObject('mlit', [
+            DAAPObject('miid', 1),
+            DAAPObject('mper', 1),
+            DAAPObject('minm', library.name),
+            DAAPObject('mimc', len(library.ids)),
+            DAAPObject('mctc', len(library.playlists) + 1),
+        ])]))
+
+    def items(self):
+        """all the tracks, or with delta=N, the ones that have changed
+        since revision N and the ids of the ones deleted. If the journal
+        doesn't go back to N, everything."""
+        library = self.server.library
+        delta = self.params.get('delta', '')
+        changes = delta.isdigit() and library.changesSince(int(delta)) or None
+        if changes is None:
+            self.sendTracks('adbs', library.ids)
+            return
+        changed, deleted = changes
+        self.sendTracks('adbs', changed, deleted, len(library.ids))
+
+    def containers(self):
+        library = self.server.library
+        # the first playlist is always the whole library
+        playlists = [DAAPObject('mlit', [
+            DAAPObject('miid', 1),
+            DAAPObject('minm', library.name),
+            DAAPObject('mimc', len(library.ids)),
+            DAAPObject('abpl', 1),
+        ])]
+        for id, name, ids in library.playlists:
+            playlists.append(DAAPObject('mlit', [
+                DAAPObject('miid', id),
+                DAAPObject('minm', name),
+                DAAPObject('mimc', len(ids)),
+            ]))
+        self.sendObject(self.listing('aply', playlists))
+
+    def containerItems(self, playlist):
+        library = self.server.library
+        if playlist == 1:
+            ids = library.ids
+        else:
+            for id, name, ids in library.playlists:
+                if id == playlist:
+                    break
+            else:
+                self.sendStatus(404)
+                return
+        self.sendTracks('apso', ids)
+
+    def artwork(self, id):
+        """the cover art for a track. We don't scale it - mw and mh are
+        only a hint."""
+        library = self.server.library
+        artwork = library.hasTrack(id) and library.artwork(id)
+        if not artwork:
+            self.sendStatus(404)
+            return
+        data, type = artwork
+        self.send_response(200)
+        self.send_header('Content-Type', type)
+        self.send_header('Content-Length', str(len(data)))
+        if self.close_connection:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.write(data)
+
+    def page(self, items):
+        """the part of items asked for by the 'index' parameter, which is
+        'first-last', inclusive, and the index of the first"""
+        match = re.match(r'(\d+)-(\d*)$', self.params.get('index', ''))
+        if not match:
+            return 0, items
+        first, last = match.groups()
+        return int(first), items[int(first):last and int(last) + 1 or None]
+
+    # the groups we can answer /groups for, by group-type. Genres only
+    # come through /browse, like older iTunes.
+    groupings = {'artists': ('agar', 'asar'), 'albums': ('agal', 'asal')}
+
+    def groups(self):
+        grouping = self.groupings.get(self.params.get('group-type'))
+        if grouping is None:
+            self.sendStatus(404)
+            return
+        code, field = grouping
+        groups = self.server.library.groups(field)
+        start, page = self.page(groups)
+        self.sendObject(DAAPObject(code, [
+            DAAPObject('mstt', 200),
+            DAAPObject('muty', 0),
+            DAAPObject('mtco', len(groups)),
+            DAAPObject('mrco', len(page)),
+            DAAPObject('mlcl', [DAAPObject('mlit', [
+                DAAPObject('miid', start + i + 1),
+                DAAPObject('minm', name),
+                DAAPObject('mimc', count),
+            ]) for i, (name, count) in enumerate(page)]),
+        ]))
+
+    browsings = {'artists': ('abar', 'asar'), 'albums': ('abal', 'asal'), 'genres': ('abgn', 'asgn')}
+
+    def browse(self, kind):
+        code, field = self.browsings[kind]
+        groups = self.server.library.groups(field)
+        start, page = self.page(groups)
+        # browse listings are bare strings, each in an mlit - which we
+        # otherwise treat as a container, so encode them by hand
+        names = ''.join([struct.pack('!4sI', 'mlit', len(name)) + name
+            for name in [name.encode('utf-8') for name, count in page]])
+        self.sendData(encodeContainer('abro', ''.join([
+            DAAPObject('mstt', 200).encode(),
+            DAAPObject('muty', 0).encode(),
+            DAAPObject('mtco', len(groups)).encode(),
+            DAAPObject('mrco', len(page)).encode(),
+            encodeContainer(code, names),
+        ])))
+
+    def byteRange(self, size):
+        """the (start, end) bytes asked for by a Range header, inclusive. None
+        if there's no usable Range header, False if it can't be satisfied."""
+        match = re.match(r'bytes=(\d*)-(\d*)$', self.headers.get('Range', '').strip())
+        if not match or match.groups() == ('', ''):
+            return None
+        first, last = match.groups()
+        if first == '':
+            # the last 'last' bytes
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start = int(first)
+            end = min(int(last), size - 1) if last else size - 1
+        if start > end or start >= size:
+            return False
+        return start, end
+
+    def download(self, id):
+        library = self.server.library
+        if not library.hasTrack(id):
+            self.sendStatus(404)
+            return
+        file, size = library.openTrack(id)
+        try:
+            byteRange = self.byteRange(size)
+            if byteRange is False:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%s' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            if byteRange:
+                start, end = byteRange
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes %s-%s/%s' % (start, end, size))
+            else:
+                start, end = 0, size - 1
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/x-dmap-tagged')
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(end - start + 1))
+            if self.close_connection:
+                self.send_header('Connection', 'close')
+            self.end_headers()
+            self.sendFile(file, start, end - start + 1)
+        finally:
+            file.close()
+
+    def sendFile(self, file, start, length):
+        """sends length bytes of file from start. Real files go through
+        sendfile(), unless we're throttling - os.sendfile, or on python 2
+        the one from pysendfile, if it's installed."""
+        import os
+        file.seek(start)
+        try:
+            from sendfile import sendfile
+        except ImportError:
+            sendfile = getattr(os, 'sendfile', None)
+        if sendfile and hasattr(file, 'fileno') and not self.server.bandwidth:
+            self.wfile.flush()
+            offset = start
+            while length > 0:
+                sent = sendfile(self.connection.fileno(), file.fileno(), offset, min(length, 1024 * 1024))
+                if not sent:
+                    break
+                offset += sent
+                length -= sent
+            return
+        while length > 0:
+            data = file.read(min(length, 64 * 1024))
+            if not data:
+                break
+            self.write(data)
+            length -= len(data)
+
+
+class DAAPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves 'library' over DAAP, one thread per connection.
+
+    gzip -- compress DMAP responses for clients that accept it
+    bandwidth -- limit each response to this many bytes per second
+    latency -- wait this many seconds before answering each request
+    max_connections -- answer 503 when more requests than this are in flight
+    one_request_per_connection -- close the connection after every
+        response, like Tangerine
+    validate -- refuse requests with a bad Client-DAAP-Validation header
+    update_timeout -- the longest an /update waits for a new revision
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, library, address = ('', 3689), gzip = False,
+            bandwidth = None, latency = 0, max_connections = None,
+            one_request_per_connection = False, validate = True,
+            update_timeout = 300, handler = DAAPRequestHandler):
+        BaseHTTPServer.HTTPServer.__init__(self, address, handler)
+        self.library = library
+        self.gzip = gzip
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.max_connections = max_connections
+        self.one_request_per_connection = one_request_per_connection
+        self.validate = validate
+        self.update_timeout = update_timeout
+        self.sessions = set()
+        self.active = 0
+        self.lock = threading.Lock()
+
+    def admit(self, limit = True):
+        """counts a request in, returns False if we're over the limit"""
+        self.lock.acquire()
+        try:
+            if limit and self.max_connections is not None and self.active >= self.max_connections:
+                return False
+            self.active += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def release(self):
+        self.lock.acquire()
+        self.active -= 1
+        self.lock.release()
+
+    def newSession(self):
+        self.lock.acquire()
+        try:
+            session = random.randint(1, 2 ** 31)
+            self.sessions.add(session)
+            return session
+        finally:
+            self.lock.release()
+
+    def hasSession(self, session):
+        try:
+            return int(session) in self.sessions
+        except (TypeError, ValueError):
+            return False
+
+    def endSession(self, session):
+        try:
+            self.sessions.discard(int(session))
+        except (TypeError, ValueError):
+            pass
+
+    def serveInBackground(self):
+        """starts serving on a daemon thread, and returns the thread. Call
+        shutdown() to stop."""
+        thread = threading.Thread(target = self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        return thread
+
+
+def main():
+    import optparse
+    parser = optparse.OptionParser()
+    parser.add_option('--port', type = 'int', default = 3689)
+    parser.add_option('--directory', help = 'serve the music files in this directory')
+    parser.add_option('--name', help = 'the name of the library')
+    parser.add_option('--advertise', action = 'store_true', default = False,
+        help = 'announce the library with multicast DNS')
+    parser.add_option('--tracks', type = 'int', default = 10000)
+    parser.add_option('--playlists', type = 'int', default = 10)
+    parser.add_option('--min-string', type = 'int', default = 4)
+    parser.add_option('--max-string', type = 'int', default = 40)
+    parser.add_option('--seed', type = 'int', default = 0)
+    parser.add_option('--gzip', action = 'store_true', default = False)
+    parser.add_option('--bandwidth', type = 'int',
+        help = 'bytes per second, per response')
+    parser.add_option('--latency', type = 'float', default = 0,
+        help = 'seconds to wait before each response')
+    parser.add_option('--max-connections', type = 'int')
+    parser.add_option('--one-request-per-connection', action = 'store_true', default = False)
+    parser.add_option('--no-validate', dest = 'validate', action = 'store_false', default = True)
+    parser.add_option('--update-timeout', type = 'float', default = 300,
+        help = 'the longest seconds an /update waits for a change')
+    options, args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG,
+            format='%(asctime)s %(levelname)s %(message)s')
+
+    if options.directory:
+        library = DirectoryLibrary(options.directory, options.name)
+    else:
+        log.info('building a library of %s tracks', options.tracks)
+        library = SyntheticLibrary(options.tracks, options.playlists,
+            (options.min_string, options.max_string), seed = options.seed,
+            name = options.name or 'Synthetic Library')
+    server = DAAPServer(library, ('', options.port), gzip = options.gzip,
+        bandwidth = options.bandwidth, latency = options.latency,
+        max_connections = options.max_connections,
+        one_request_per_connection = options.one_request_per_connection,
+        validate = options.validate, update_timeout = options.update_timeout)
+    log.info('serving on port %s', options.port)
+    responder = None
+    if options.advertise:
+        from daap_discovery import MDNSResponder
+        responder = MDNSResponder(library.name, options.port)
+        responder.start()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    if responder is not None:
+        responder.stop()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#
+# Measures how long 'import daap' takes in a fresh interpreter, and fails
+# if that goes over budget, or if the import drags in modules that should
+# only be loaded once we talk to a server. Run it after touching the top
+# of daap.py:
+#
+#   python daap_startup.py [--runs N] [--budget MS]
+#
+# The modules are byte-compiled first, so what's timed is an ordinary
+# import from .pyc files, not the compiler.
+
+import os, sys
+import optparse
+import subprocess
+import py_compile
+
+# modules that importing daap must not load by itself
+DEFERRED = ['httplib', 'gzip', 'zlib', 'md5', 'hashlib', 'Queue', 'base64',
+    'mmap', 'multiprocessing', 'daap_path', 'daap_encode', 'daap_scheduling',
+    'daap_fingerprints']
+
+# what gets compiled before measuring
+MODULES = ['daap', 'daap_path', 'daap_encode', 'daap_scheduling',
+    'daap_fingerprints']
+
+# runs in the child interpreter. Prints the import time in milliseconds,
+# then any deferred modules that got loaded anyway.
+PROBE = """
+import sys, time
+before = set(sys.modules)
+start = time.time()
+import daap
+elapsed = (time.time() - start) * 1000
+loaded = [m for m in %r if sys.modules.get(m) and m not in before]
+print elapsed
+print ' '.join(loaded)
+""" % DEFERRED
+
+def compile():
+    """byte-compiles daap and the modules it imports lazily, so the
+    children load them from .pyc"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    for module in MODULES:
+        py_compile.compile(os.path.join(here, module + '.py'), doraise = True)
+
+def measure(runs):
+    """imports daap in 'runs' fresh interpreters, returns the sorted import
+    times and the deferred modules that were loaded by any of them"""
+    times = []
+    loaded = set()
+    for i in range(runs):
+        output = subprocess.Popen([sys.executable, '-c', PROBE],
+            stdout = subprocess.PIPE,
+            cwd = os.path.dirname(os.path.abspath(__file__))).communicate()[0]
+        lines = output.split('\n')
+        times.append(float(lines[0]))
+        loaded.update(lines[1].split())
+    times.sort()
+    return times, loaded
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option('--runs', type = 'int', default = 10,
+        help = 'number of fresh interpreters to time')
+    parser.add_option('--budget', type = 'float', default = 15.0,
+        help = 'maximum median import time, in milliseconds')
+    options, args = parser.parse_args()
+
+    compile()
+    times, loaded = measure(options.runs)
+    median = times[len(times) // 2]
+    print "import daap: median %.2fms, min %.2fms, max %.2fms over %s runs" % (
+        median, times[0], times[-1], len(times))
+
+    failed = False
+    if median > options.budget:
+        print "FAIL: median import time is over the %.2fms budget" % options.budget
+        failed = True
+    if loaded:
+        print "FAIL: import daap loaded %s" % ', '.join(sorted(loaded))
+        failed = True
+    if failed:
+        sys.exit(1)
+    print "ok"
+
+if __name__ == '__main__':
+    main()
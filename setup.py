@@ -7,7 +7,7 @@ setup (
   author_email = "tom@jerakeen.org",
   url = "http://jerakeen.org/code/pythondaap",
   description = "a python daap client library",
-  py_modules = ['daap'],
+  py_modules = ['daap', 'daap_server', 'daap_discovery', 'daap_federation', 'daap_export', 'daap_mirror', 'daap_artwork', 'daap_broker', 'daap_path', 'daap_encode', 'daap_scheduling', 'daap_fingerprints'],
   ext_modules = [Extension('md5daap',sources=['md5module.c', 'md5.c'])],
   license = "LGPL",
 )